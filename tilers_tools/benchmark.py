@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import sys
+import os
+import time
+import logging
+import optparse
+import collections
+from subprocess import Popen, PIPE
+
+from tiler_functions import *
+
+benchmarks = {}
+
+#----------------------------
+
+def timings(func, repeat):
+    'run a function a few times, returns (best, median) of the run times'
+#----------------------------
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+#----------------------------
+
+def report(name, best, median, unit='ms', scale=1000.):
+
+#----------------------------
+    pf('%-30s best %8.1f %s  median %8.1f %s' % (name, best * scale, unit, median * scale, unit))
+
+#----------------------------
+
+def bench_startup(args, options):
+    'start-up time of the tools and import time of the modules'
+#----------------------------
+    tools = args or ['tiler.py', 'tiles_convert.py', 'map2gdal.py']
+    modules = ['tiler_functions', 'tiler_backend', 'converter_backend', 'reader_backend']
+
+    def run(cmd):
+        def func():
+            Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=data_dir()).communicate()
+        return func
+
+    for tool in tools:
+        best, median = timings(run([sys.executable, tool, '--version']), options.repeat)
+        report(tool, best, median)
+
+    for module in modules:
+        best, median = timings(run([sys.executable, '-c', 'import %s' % module]), options.repeat)
+        report('import ' + module, best, median)
+
+benchmarks['startup'] = bench_startup
+
+#----------------------------
+
+def bench_traversal(args, options):
+    '''source block reads by the order of the tile tree traversal,
+    simulated with an LRU block cache: traversal [DEPTH [CACHE_BLOCKS [SCALE]]]'''
+#----------------------------
+    depth = int(args[0]) if args else 6
+    cache_blocks = int(args[1]) if len(args) > 1 else 256
+    scale = float(args[2]) if len(args) > 2 else 1.37 # source pixels per base tile pixel
+    block = 256
+    top_tiles = [(0, x, y) for y in range(3) for x in range(4)]
+
+    def src_blocks(tile):
+        'source blocks a base tile is warped from'
+        z, x, y = tile
+        x0, y0 = [int(i * block * scale) // block for i in (x, y)]
+        x1, y1 = [int((i + 1) * block * scale - 1) // block for i in (x, y)]
+        return [(bx, by) for by in range(y0, y1 + 1) for bx in range(x0, x1 + 1)]
+
+    def children(tile):
+        z, x, y = tile
+        return [(z + 1, x * 2 + i, y * 2 + j) for i in range(2) for j in range(2)]
+
+    def dict_children(tile): # the former order: keys of a dict
+        return dict(((ch, None) for ch in children(tile))).keys()
+
+    def morton_children(tile):
+        return morton_order(children(tile))
+
+    def walk(tiles, child_order):
+        for tile in tiles:
+            if tile[0] == depth:
+                yield tile
+            else:
+                for base_tile in walk(child_order(tile), child_order):
+                    yield base_tile
+
+    traversals = [
+        ('rows, dict order', top_tiles, dict_children),
+        ('Z-order', morton_order(top_tiles), morton_children),
+        ]
+    for name, tiles, child_order in traversals:
+        start = time.time()
+        cache = collections.OrderedDict()
+        reads = 0
+        for tile in walk(tiles, child_order):
+            for blk in src_blocks(tile):
+                if blk in cache:
+                    del cache[blk]
+                else:
+                    reads += 1
+                    if len(cache) >= cache_blocks:
+                        cache.popitem(last=False)
+                cache[blk] = True
+        unique = len(set(flatten((src_blocks(tile) for tile in walk(tiles, child_order)))))
+        pf('%-30s block reads %8d  re-reads %8d (%5.1f%%)  %6.1f ms' % (
+            name, reads, reads - unique, 100. * (reads - unique) / unique, (time.time() - start) * 1000))
+
+benchmarks['traversal'] = bench_traversal
+
+#----------------------------
+
+def bench_codecs(args, options):
+    '''in-process PIL converters against the external programmes: codecs TILE_FILE...'''
+#----------------------------
+    import converter_backend
+
+    if not args:
+        logging.error('Specify a few tile files to convert')
+        return
+    tiles = [converter_backend.FileTile((0, 0, i), path) for i, path in enumerate(args)]
+    conv_options = LooseDict(colors='256', quality=75)
+    pairs = [
+        ('pngnq', 'pngnq-pil'),
+        ('webp', 'webp-pil'),
+        ('webp-noalpha', 'webp-noalpha-pil'),
+        ]
+    for profiles in pairs:
+        for profile in profiles:
+            try:
+                converter = converter_backend.TileConverter.get_class(profile)(conv_options)
+            except Exception as exc:
+                pf('%-30s %s' % (profile, exc))
+                continue
+            sizes = []
+            def convert():
+                del sizes[:]
+                for tile in tiles:
+                    dst = converter(tile)
+                    if dst is None:
+                        continue
+                    sizes.append(len(dst.data()))
+                    if dst.temp:
+                        remove_file(dst.path)
+            best, median = timings(convert, options.repeat)
+            report(profile, best / len(tiles), median / len(tiles), 'ms/tile')
+            if sizes:
+                pf('%-30s %d tiles, %.0f bytes/tile' % ('', len(sizes), float(sum(sizes)) / len(sizes)))
+
+benchmarks['codecs'] = bench_codecs
+
+#----------------------------
+
+def bench_mapper(args, options):
+    '''maemo-mapper SQLite writes, bulk load against row by row inserts: mapper [TILES [TILE_BYTES]]'''
+#----------------------------
+    import random
+    import tempfile
+    import converter_backend
+    import converter_maemomapper
+
+    n_tiles = int(args[0]) if args else 20000
+    tile_bytes = int(args[1]) if len(args) > 1 else 10000
+    side = 1 << 8
+    coords = [(8, i % side, i // side) for i in range(n_tiles)]
+    random.shuffle(coords) # as they come from the workers
+    data = '\x89PNG\r\n\x1a\n' + os.urandom(tile_bytes - 8)
+    tiles = [converter_backend.PixBufTile(coord, data) for coord in coords]
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench-mapper-')
+    src = LooseDict(root=os.path.join(tmp_dir, 'src'), ext='.png')
+    db_options = LooseDict(tiles_srs='EPSG:3857', remove_dest=True, dst_dir=tmp_dir, db_buffer=16)
+    try:
+        for name, bulk in (('row by row', False), ('bulk load', True)):
+            def store():
+                converter_maemomapper.MapperSQLite.bulk_load = bulk
+                tileset = converter_maemomapper.MapperSQLite(options=db_options, src=src)
+                for tile in tiles:
+                    tileset.store_tile(tile)
+                tileset.finalize_tileset()
+            best, median = timings(store, options.repeat)
+            pf('%-30s best %8.0f tiles/s  median %8.0f tiles/s' % (name, n_tiles / best, n_tiles / median))
+    finally:
+        converter_maemomapper.MapperSQLite.bulk_load = True
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+benchmarks['mapper'] = bench_mapper
+
+#----------------------------
+
+def main(argv):
+
+#----------------------------
+    parser = optparse.OptionParser(
+        usage='usage: %prog [<options>...] <benchmark> [<args>...]',
+        version=version,
+        description='performance benchmarks: ' + ', '.join(sorted(benchmarks)))
+    parser.add_option('-n', '--repeat', type='int', default=10,
+        help='number of runs (default: 10)')
+    parser.add_option('-d', '--debug', action='store_true', dest='debug')
+    parser.add_option('--quiet', action='store_true', dest='quiet')
+
+    (options, args) = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.DEBUG if options.debug else
+        (logging.ERROR if options.quiet else logging.INFO))
+    log(options.__dict__)
+
+    if not args or args[0] not in benchmarks:
+        parser.error('Specify a benchmark: %s' % ', '.join(sorted(benchmarks)))
+
+    benchmarks[args[0]](args[1:], LooseDict(options))
+
+# main()
+
+if __name__ == '__main__':
+
+    main(sys.argv)
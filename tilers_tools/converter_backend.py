@@ -31,14 +31,37 @@ import json
 import tempfile
 import StringIO
 import struct
-from multiprocessing import Pool
+import zlib
+import mmap
+import time
+import traceback
+import Queue
+from multiprocessing import Pool, Process, Queue as ProcessQueue
 import itertools
 
 from PIL import Image
 #~ from PIL import WebPImagePlugin
 
 from tiler_functions import *
-from tiler import Pyramid
+from tiler_backend import Pyramid
+from tiler_inventory import TileInventory
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # a backport
+    except ImportError:
+        scandir = None
+
+def dir_names(path, dirs):
+    'names of the sub-directories (or of all the entries) of a directory, one listing call'
+    try:
+        if scandir is None:
+            return os.listdir(path) # sub-directories are told from files when listed in turn
+        return [entry.name for entry in scandir(path) if not dirs or entry.is_dir()]
+    except OSError:
+        return []
 
 #############################
 
@@ -252,37 +275,24 @@ class WebpNoAlphaConverter (ShellConverter):
 
 tile_converters.append(WebpNoAlphaConverter)
 
-
-#~ #############################
-#~
-#~ class WebpPilConverter (TileConverter):
-    #~ 'convert to webp'
-#~ #############################
-    #~ profile_name = 'webppil'
-    #~ dst_ext = '.webp'
-    #~ src_formats = ('.png','.jpg','.jpeg','.gif')
-#~
-    #~ def convert_tile(self, src, dst, dpath):
-        #~ img = Image.open(src)
-        #~ img.save(dst, optimize=True, quality=self.options.quality)
-#~
-#~ tile_converters.append(WebpPilConverter)
-
-
 #############################
 
-class JpegConverter (TileConverter):
-    'convert to jpeg'
+class PilConverter (TileConverter):
+    'convert tiles in memory with PIL, no temporary files or external programmes'
 #############################
-    profile_name = 'jpeg'
-    dst_ext = '.jpg'
-    src_formats = ('.png', '.gif')
+    pil_format = None
+
+    def __init__(self, options):
+        super(PilConverter, self).__init__(options)
+        Image.init()
+        if self.pil_format not in Image.SAVE:
+            raise Exception('PIL can not write %s' % self.pil_format)
 
     def convert_tile(self, tile):
         src = StringIO.StringIO(tile.data())
         img = Image.open(src)
         dst = StringIO.StringIO()
-        img.save(dst, 'jpeg', optimize=True, quality=self.options.quality)
+        self.save(img, dst)
 
         dtile = PixBufTile(tile.coord(), dst.getvalue())
         src.close()
@@ -290,11 +300,86 @@ class JpegConverter (TileConverter):
 
         return dtile
 
+#############################
+
+class JpegConverter (PilConverter):
+    'convert to jpeg'
+#############################
+    profile_name = 'jpeg'
+    dst_ext = '.jpg'
+    src_formats = ('.png', '.gif')
+    pil_format = 'JPEG'
+
+    def save(self, img, dst):
+        img.save(dst, 'jpeg', optimize=True, quality=self.options.quality)
+
 tile_converters.append(JpegConverter)
 
+#############################
+
+class PngPilConverter (PilConverter):
+    'optimize png: quantize to 8 bit/pixel with PIL (libimagequant, if available), like pngnq'
+#############################
+    profile_name = 'pngnq-pil'
+    dst_ext = '.png'
+    src_formats = ('.png',)
+    pil_format = 'PNG'
+
+    # quantization methods by preference, RGBA images can't use the median cut
+    quantize_methods = [getattr(Image, 'LIBIMAGEQUANT', 3), getattr(Image, 'FASTOCTREE', 2)]
+
+    def save(self, img, dst):
+        if img.mode != 'P':
+            img = img.convert('RGBA')
+            for method in self.quantize_methods[:]:
+                try:
+                    img = img.quantize(int(self.options.colors), method=method)
+                    break
+                except ValueError: # PIL is built without this method
+                    self.quantize_methods.remove(method)
+        img.save(dst, 'png', optimize=True)
+
+tile_converters.append(PngPilConverter)
+
+#############################
+
+class WebpPilConverter (PilConverter):
+    'convert to webp with PIL'
+#############################
+    profile_name = 'webp-pil'
+    dst_ext = '.webp'
+    src_formats = ('.png','.jpg','.jpeg','.gif')
+    pil_format = 'WEBP'
+
+    def save(self, img, dst):
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        if img.mode == 'RGBA': # like 'cwebp -alpha_cleanup': RGB under transparent pixels is not kept
+            transparent = img.split()[3].point(lambda a: 255 if a == 0 else 0)
+            img = Image.composite(Image.new('RGBA', img.size, (0, 0, 0, 0)), img, transparent)
+        img.save(dst, 'webp', quality=self.options.quality)
+
+tile_converters.append(WebpPilConverter)
+
+#############################
+
+class WebpNoAlphaPilConverter (WebpPilConverter):
+    'convert to webp with PIL; discard alpha channel'
+#############################
+    profile_name = 'webp-noalpha-pil'
+
+    def save(self, img, dst):
+        img.convert('RGB').save(dst, 'webp', quality=self.options.quality)
+
+tile_converters.append(WebpNoAlphaPilConverter)
+
 #----------------------------
 
-tileset_profiles = []
+tileset_profiles = PluginRegistry('format')
+tileset_profiles.register('converter_xyz', 'tms', 'xyz', 'zyx', 'mapnav')
+tileset_profiles.register('converter_maemomapper', 'mapper', 'gdbm')
+tileset_profiles.register('converter_sasplanet', 'sasplanet', 'sdb', 'slite')
+tileset_profiles.register('converter_mbtiles', 'mbtiles')
 
 tile_converter = None
 
@@ -305,6 +390,96 @@ def global_converter(tile):
 
 #############################
 
+class ShmRing(object):
+    '''tile payloads in slots of a shared memory map;
+    it's created before the worker pool forks, so the workers share it'''
+#############################
+    slot_size = 256 << 10
+
+    def __init__(self, size_mb):
+        self.n_slots = max(2, (size_mb << 20) // self.slot_size)
+        self.mm = mmap.mmap(-1, self.n_slots * self.slot_size)
+        self.free = Queue.Queue()
+        for slot in range(self.n_slots):
+            self.free.put(slot)
+
+    def acquire(self):
+        'a free slot, waits for the results to release one'
+        return self.free.get()
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def put(self, slot, data):
+        offset = slot * self.slot_size
+        self.mm[offset: offset + len(data)] = data
+
+    def get(self, slot, length):
+        offset = slot * self.slot_size
+        return self.mm[offset: offset + length]
+
+#############################
+
+class SlotTile(Tile):
+    'descriptor of a tile with its payload in a ring slot'
+#############################
+    def __init__(self, coord, slot, length, data_type=None):
+        super(SlotTile, self).__init__(coord)
+        self.slot = slot
+        self.length = length
+        self.data_type = data_type
+
+shm_ring = None
+
+def shm_converter(tile):
+    '''convert a tile, the payload of a slot tile is read from the ring and
+    the result is written back into the same slot if it fits; returns (slot, tile)'''
+    slot = getattr(tile, 'slot', None)
+    if slot is None:
+        return None, global_converter(tile)
+
+    tile = PixBufTile(tile.coord(), shm_ring.get(slot, tile.length), dataType=tile.data_type)
+    dst = tile_converter(tile)
+    if isinstance(dst, PixBufTile) and len(dst.pixbuf) <= shm_ring.slot_size:
+        shm_ring.put(slot, dst.pixbuf)
+        dst = SlotTile(dst.coord(), slot, len(dst.pixbuf), dst.data_type)
+    return slot, dst
+
+def update_zoom_levels(zoom_levels, tl_zxy, br_zxy):
+    'min max tile numbers of a zoom: {zoom: [[z, x_min, y_min], [z, x_max, y_max]]}'
+    z = tl_zxy[0]
+    min_max = zoom_levels.get(z, []) # min, max
+    zzz, xxx, yyy = zip(*(min_max + [list(tl_zxy), list(br_zxy)]))
+    zoom_levels[z] = [[z, min(xxx), min(yyy)], [z, max(xxx), max(yyy)]]
+
+read_batch = 64 # tiles sent by a reader at once
+
+class ReaderError(Exception): pass
+
+def read_shards(tileset, shards, queue, reader_id):
+    '''a reader process: sends the tiles of its shards in batches (lists), the zoom levels
+    of each shard read (a dict), its id when done or a ReaderError when a shard has failed'''
+    for shard in shards:
+        zoom_levels = {}
+        batch = []
+        try:
+            for tile in tileset.iter_shard(shard):
+                zxy = tile.coord()
+                update_zoom_levels(zoom_levels, zxy, zxy)
+                batch.append(tile)
+                if len(batch) >= read_batch:
+                    queue.put(batch)
+                    batch = []
+        except Exception:
+            queue.put(ReaderError('Reading %s\n%s' % (shard, traceback.format_exc())))
+            return
+        if batch:
+            queue.put(batch)
+        queue.put(zoom_levels)
+    queue.put(reader_id)
+
+#############################
+
 class TileSet(object):
 
 #############################
@@ -355,22 +530,24 @@ class TileSet(object):
                     assert self.options.append, 'Destination already exists: %s' % root
 
             if self.options.convert_tile:
-                global tile_converter
+                global tile_converter, shm_ring
                 tile_converter = TileConverter.get_class(self.options.convert_tile)(options)
                 if not (self.options.nothreads or self.options.debug):
+                    if self.options.shm_ring and os.name == 'posix': # the workers are forked
+                        shm_ring = ShmRing(self.options.shm_ring)
                     self.pool = Pool()
 
     @staticmethod
     def get_class(profile, isDest=False):
-        for cls in tileset_profiles:
-            if profile == cls.format and ((not isDest and cls.input) or (isDest and cls.output)):
+        for cls in tileset_profiles.lookup(profile):
+            if (not isDest and cls.input) or (isDest and cls.output):
                 return cls
         else:
             raise Exception('Invalid format: %s' % profile)
 
     @staticmethod
     def list_profiles():
-        for cl in tileset_profiles:
+        for cl in tileset_profiles.load_all():
             print '%10s\t%s%s\t%s' % (
                 cl.format,
                 'r' if cl.input else ' ',
@@ -389,17 +566,85 @@ class TileSet(object):
             return True
         return self.pyramid.in_range(ul_coords, lr_coords)
 
+    def zoom_bounds(self, zoom):
+        '''tiles of a zoom in range: None if none of them, () if all of them,
+        otherwise (xmin, ymin, xmax, ymax) -- to be pushed down into a database query'''
+        if not self.pyramid.zoom_in_range(zoom):
+            return None
+        region_zoom = self.options.region_zoom
+        if not self.options.region or (region_zoom is not None and zoom < region_zoom):
+            return ()
+        (z, xmin, ymin), (z, xmax, ymax) = self.pyramid.corner_tiles(zoom)
+        return xmin, ymin, xmax, ymax
+
+    def range_sql(self, zooms, zoom_sql):
+        '''WHERE clause for the zooms and the region, so that the key index is used;
+        zoom_sql(zoom, bounds) gives (condition, parameters) for a zoom in range'''
+        if not (self.options.zoom or self.options.region):
+            return '', ()
+        terms = []
+        params = []
+        for zoom in zooms:
+            bounds = self.zoom_bounds(zoom)
+            if bounds is None:
+                continue
+            term, term_params = zoom_sql(zoom, bounds)
+            terms.append(term)
+            params.extend(term_params)
+        if not terms:
+            return ' WHERE 0', ()
+        return ' WHERE ' + ' OR '.join(terms), params
+
+    sqlite_mmap_size = 256 << 20
+
+    def sqlite_reader(self, db_path):
+        'a read-only connection to a source database, its pages are memory mapped'
+        import sqlite3
+        db = sqlite3.connect(db_path)
+        db.execute('PRAGMA query_only = ON;')
+        db.execute('PRAGMA mmap_size = %d;' % self.sqlite_mmap_size)
+        return db
+
     def __del__(self):
         log('self.count', self.count)
 
     def __iter__(self): # to be defined by a child
         raise Exception('Not implemented!')
 
+    def shards(self):
+        'parts of a source which can be read in parallel, None if it is read as a whole'
+        return None
+
+    def iter_shard(self, shard): # to be defined by a child with shards
+        raise Exception('Not implemented!')
+
     def convert(self):
         pf('%s -> %s ' % (self.src.root, self.root), end='')
 
-        if self.pool:
-            src = self.pool.imap_unordered(global_converter, self.src, chunksize=10)
+        shards = None
+        if (self.options.readers and not self.options.convert_tile and os.name == 'posix' # the readers are forked
+                and not (self.options.nothreads or self.options.debug)):
+            shards = self.src.shards()
+
+        sharded = shards and len(shards) > 1
+        if sharded:
+            src = self.read_sharded(shards)
+        elif self.pool:
+            src = iter(self.src)
+            # convert a few tiles here to pick a chunk size
+            probe = list(itertools.islice(src, self.probe_tiles))
+            start = time.time()
+            probe_results = map(global_converter, probe)
+            chunksize = self.chunk_size(probe, time.time() - start)
+            for tile in probe_results:
+                if tile is not None:
+                    self.process_tile(tile)
+
+            if shm_ring:
+                src = self.pool.imap_unordered(shm_converter, self.ring_tiles(src), chunksize=chunksize)
+                src = self.ring_results(src)
+            else:
+                src = self.pool.imap_unordered(global_converter, src, chunksize=chunksize)
         elif self.options.convert_tile:
             src = itertools.imap(global_converter, self.src)
         else:
@@ -407,7 +652,7 @@ class TileSet(object):
 
         for tile in src:
             if tile is not None:
-                self.process_tile(tile)
+                self.process_tile(tile, track_zooms=not sharded) # zoom levels come from the readers
 
         if self.pool:
             self.pool.close()
@@ -420,18 +665,95 @@ class TileSet(object):
             pf('No tiles converted', end='')
         pf('')
 
-    def process_tile(self, tile):
+    probe_tiles = 16
+    chunk_time = 0.02       # seconds of conversion to send to a worker at once
+    chunk_bytes = 4 << 20   # limits payloads pickled at once
+
+    def chunk_size(self, probe, elapsed):
+        'tiles per a pool task: larger for fast conversions, smaller for big tiles'
+        if not probe:
+            return 1
+        tile_time = max(elapsed / len(probe), 1e-6)
+        chunksize = int(self.chunk_time / tile_time)
+        if shm_ring: # the ring keeps a few chunks per worker in flight
+            chunksize = min(chunksize, shm_ring.n_slots // (2 * cpu_count()))
+        else:
+            sizes = [len(tile.pixbuf) for tile in probe if isinstance(tile, PixBufTile)]
+            if sizes:
+                chunksize = min(chunksize, self.chunk_bytes * len(sizes) // sum(sizes))
+        chunksize = max(1, min(chunksize, 256))
+        ld('chunk_size', tile_time, chunksize)
+        return chunksize
+
+    def ring_tiles(self, src):
+        '''replace tile payloads with ring slot descriptors;
+        waiting for a free slot holds up reading while the destination is behind'''
+        for tile in src:
+            if isinstance(tile, PixBufTile) and len(tile.pixbuf) <= shm_ring.slot_size:
+                slot = shm_ring.acquire()
+                shm_ring.put(slot, tile.pixbuf)
+                tile = SlotTile(tile.coord(), slot, len(tile.pixbuf), tile.data_type)
+            yield tile
+
+    def ring_results(self, results):
+        'converted tiles, the payloads are taken out of the ring'
+        for slot, tile in results:
+            if isinstance(tile, SlotTile):
+                tile = PixBufTile(tile.coord(), shm_ring.get(tile.slot, tile.length), dataType=tile.data_type)
+            if slot is not None:
+                shm_ring.release(slot)
+            yield tile
+
+    def read_sharded(self, shards):
+        'tiles of the source read by a few processes, each of them owns a subset of the shards'
+        n_readers = min(self.options.readers, len(shards))
+        queue = ProcessQueue(n_readers * 4)
+        readers = [Process(target=read_shards, args=(self.src, shards[i::n_readers], queue, i))
+            for i in range(n_readers)]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        try:
+            running = set(range(n_readers))
+            dead = set()
+            while running:
+                try:
+                    msg = queue.get(timeout=self.reader_timeout)
+                except Queue.Empty:
+                    # a reader gone without its last message (killed, crashed); give it one more
+                    # timeout in case the message is still on its way
+                    gone = set(i for i in running if readers[i].exitcode is not None)
+                    if gone & dead:
+                        raise ReaderError('Reader process has quit, exit code %s' %
+                            ', '.join(str(readers[i].exitcode) for i in gone & dead))
+                    dead = gone
+                    continue
+                if isinstance(msg, ReaderError):
+                    raise msg
+                elif isinstance(msg, int): # a reader is done
+                    running.discard(msg)
+                elif isinstance(msg, dict): # a shard is read
+                    for tl_zxy, br_zxy in msg.values():
+                        update_zoom_levels(self.zoom_levels, tl_zxy, br_zxy)
+                else:
+                    for tile in msg:
+                        yield tile
+        finally:
+            for reader in readers:
+                if reader.is_alive():
+                    reader.terminate()
+                reader.join()
+
+    reader_timeout = 5 # seconds to wait for a reader before checking it's alive
+
+    def process_tile(self, tile, track_zooms=True):
         #~ log('process_tile', tile)
         self.store_tile(tile)
         self.counter()
 
-        # collect min max values for tiles processed
-        zxy = list(tile.coord())
-        z = zxy[0]
-
-        min_max = self.zoom_levels.get(z, []) # min, max
-        zzz, xxx, yyy = zip(*(min_max+[zxy]))
-        self.zoom_levels[z] = [[z, min(xxx), min(yyy)], [z, max(xxx), max(yyy)]]
+        if track_zooms: # collect min max values for tiles processed
+            zxy = tile.coord()
+            update_zoom_levels(self.zoom_levels, zxy, zxy)
         tile.close_file()
 
     def finalize_pyramid(self):
@@ -486,8 +808,77 @@ class TileDir(TileSet):
                 os.makedirs(self.root)
             except os.error: pass
 
+    # path grammar, a (regex, numbers) per level from the root: zoom 'z' (or 'z1' counted from 1),
+    # tile's 'x' and 'y', 'tms_y' counted upwards, 'x8', 'y8', 'x10', 'y10' for x >> 8 etc
+    path_levels = None
+
     def __iter__(self):
-        for f in glob.iglob(os.path.join(self.root, self.dir_pattern)):
+        for f in self.tile_files():
+            coord = self.path2coord(f)
+            if self.in_range(coord):
+                yield self.tile_class(coord, f)
+
+    def tile_files(self):
+        if not self.path_levels:
+            return glob.iglob(os.path.join(self.root, self.dir_pattern))
+        return self.walk(self.root, self.compiled_levels())
+
+    def compiled_levels(self):
+        return [(re.compile(regex), numbers) for regex, numbers in self.path_levels]
+
+    def walk(self, path, levels, zoom=None, bounds=()):
+        'files of the path grammar, descends only into the zooms and the x, y ranges in range'
+        leaf = len(levels) == 1
+        for sub_path, sub_zoom, sub_bounds in self.walk_level(path, levels[0], leaf, zoom, bounds):
+            if leaf:
+                yield sub_path
+            else:
+                for f in self.walk(sub_path, levels[1:], sub_zoom, sub_bounds):
+                    yield f
+
+    def walk_level(self, path, level, leaf, zoom, bounds):
+        'entries of a directory in range: (path, zoom, bounds)'
+        regex, numbers = level
+        for name in dir_names(path, not leaf):
+            match = regex.match(name)
+            if not match:
+                continue
+            name_zoom, name_bounds = zoom, bounds
+            for key, n in zip(numbers, map(int, match.groups())):
+                if key in ('z', 'z1'):
+                    name_zoom = n - (key == 'z1')
+                    name_bounds = self.zoom_bounds(name_zoom)
+                    if name_bounds is None:
+                        break
+                elif name_bounds and not self.number_in_range(key, n, name_zoom, name_bounds):
+                    break
+            else:
+                yield os.path.join(path, name), name_zoom, name_bounds
+
+    def number_in_range(self, key, n, zoom, bounds):
+        xmin, ymin, xmax, ymax = bounds
+        if key == 'tms_y':
+            ymin, ymax = 2**zoom - 1 - ymax, 2**zoom - 1 - ymin
+        shift = int(key[1:]) if key[1:].isdigit() else 0
+        if key[0] == 'x':
+            return xmin >> shift <= n <= xmax >> shift
+        return ymin >> shift <= n <= ymax >> shift
+
+    shard_depth = 2 # directory levels above a shard
+
+    def shards(self):
+        'directory subtrees: (path, level, zoom, bounds)'
+        if not self.path_levels or len(self.path_levels) <= self.shard_depth:
+            return None
+        levels = self.compiled_levels()
+        subtrees = [(self.root, None, ())]
+        for level in levels[:self.shard_depth]:
+            subtrees = flatten(self.walk_level(path, level, False, zoom, bounds) for path, zoom, bounds in subtrees)
+        return [(path, self.shard_depth, zoom, bounds) for path, zoom, bounds in subtrees]
+
+    def iter_shard(self, shard):
+        path, level, zoom, bounds = shard
+        for f in self.walk(path, self.compiled_levels()[level:], zoom, bounds):
             coord = self.path2coord(f)
             if self.in_range(coord):
                 yield self.tile_class(coord, f)
@@ -520,10 +911,45 @@ class TileDir(TileSet):
 class TileMapDir(TileDir):
 
 #############################
+    path_template = '%i/%i/%i' # numbers of a tile path, see TileInventory
+
+    def __init__(self, *args, **kw_args):
+        super(TileMapDir, self).__init__(*args, **kw_args)
+
+        self.inventory = None
+        zoom_dirs = glob.glob(os.path.join(self.root, self.dir_pattern.split('/')[0]))
+        # an existing tile set without an inventory can not be indexed partially
+        if TileInventory.exists(self.root) or (self.options.isDest and not zoom_dirs):
+            self.inventory = TileInventory(self.root, self.path_template, hashes=self.options.tile_hashes)
+
+    def shards(self):
+        if self.inventory is not None: # no need to scan the directories
+            return None
+        return super(TileMapDir, self).shards()
+
+    def __iter__(self):
+        if self.inventory is None:
+            for tile in super(TileMapDir, self).__iter__():
+                yield tile
+            return
+        for path in self.inventory.paths(): # no need to scan the directories
+            f = os.path.join(self.root, path)
+            coord = self.path2coord(f)
+            if self.in_range(coord):
+                yield self.tile_class(coord, f)
+
+    def store_tile(self, tile):
+        super(TileMapDir, self).store_tile(tile)
+        if self.inventory is not None:
+            crc = zlib.crc32(tile.data()) if self.options.tile_hashes else None
+            self.inventory.set(self.inventory.tile(self.coord2path(*tile.coord())), crc=crc)
 
     def finalize_tileset(self):
         self.pyramid.tile_ext = self.tile_ext
         self.pyramid.dest = self.root
         self.pyramid.write_metadata()
+        if self.inventory is not None:
+            self.inventory.set_ext(self.tile_ext)
+            self.inventory.flush()
 
 # TileMapDir
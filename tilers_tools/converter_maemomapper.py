@@ -33,14 +33,29 @@ class MapperSQLite(TileSet):
     format, ext, input, output = 'mapper', '.db', True, True
     max_zoom = 20
 
-    def __init__(self, root, options=None):
-        super(MapperSQLite, self).__init__(root, options)
+    bulk_load = True # a new database is loaded without the key index, the index is built at the end
+
+    def __init__(self, *args, **kw_args):
+        super(MapperSQLite, self).__init__(*args, **kw_args)
 
         import sqlite3
 
-        self.db = sqlite3.connect(self.root)
+        self.bulk = self.options.isDest and self.bulk_load and not os.path.exists(self.root)
+        self.db = sqlite3.connect(self.root) if self.options.isDest else self.sqlite_reader(self.root)
         self.dbc = self.db.cursor()
-        if self.options.isDest:
+        if self.bulk:
+            self.pending = {} # key -> pixbuf, the last stored tile wins, as with INSERT OR REPLACE
+            self.pending_bytes = 0
+            self.buffer_bytes = (self.options.db_buffer or 16) << 20
+            self.dbc.execute('PRAGMA synchronous = OFF;') # a new file: nothing to lose on a crash
+            self.dbc.execute(
+                'CREATE TABLE maps ('
+                    'zoom INTEGER, '
+                    'tilex INTEGER, '
+                    'tiley INTEGER, '
+                    'pixbuf BLOB);'
+                )
+        elif self.options.isDest:
             try:
                 self.dbc.execute (
                     'CREATE TABLE maps ('
@@ -54,21 +69,50 @@ class MapperSQLite(TileSet):
                 pass
 
     def finalize_tileset(self):
+        if self.bulk:
+            self.flush()
+            # a tile written again by a later flush: the last one wins, as with INSERT OR REPLACE
+            self.dbc.execute('DELETE FROM maps WHERE rowid NOT IN '
+                '(SELECT MAX(rowid) FROM maps GROUP BY zoom, tilex, tiley);')
+            self.dbc.execute('CREATE UNIQUE INDEX maps_key ON maps (zoom, tilex, tiley);')
         self.db.commit()
         self.db.close()
 
+    def flush(self):
+        'write the buffered tiles in the key order in one transaction'
+        self.dbc.executemany('INSERT INTO maps (zoom, tilex, tiley, pixbuf) VALUES (?, ?, ?, ?);',
+            (key + (self.pending[key],) for key in sorted(self.pending)))
+        self.db.commit()
+        self.pending = {}
+        self.pending_bytes = 0
+
     def __iter__(self):
-        self.dbc.execute('SELECT * FROM maps')
+        where, params = self.range_sql(range(self.max_zoom + 1), self.zoom_sql)
+        self.dbc.execute('SELECT zoom, tilex, tiley, pixbuf FROM maps' + where, params)
         for z, x, y, pixbuf in self.dbc:
             coord = self.max_zoom+1-z, x, y
-            if self.in_range(coord):
-                yield PixBufTile(coord, str(pixbuf), (z, x, y))
+            yield PixBufTile(coord, str(pixbuf), (z, x, y))
+
+    def zoom_sql(self, zoom, bounds):
+        'condition on the tiles of a zoom in range, see range_sql()'
+        z = self.max_zoom+1-zoom
+        if not bounds:
+            return 'zoom = ?', (z,)
+        xmin, ymin, xmax, ymax = bounds
+        return '(zoom = ? AND tilex BETWEEN ? AND ? AND tiley BETWEEN ? AND ?)', (z, xmin, xmax, ymin, ymax)
 
     def store_tile(self, tile):
         z, x, y = tile.coord()
         # convert to maemo-mapper coords
         z = self.max_zoom+1-z
         log('%s -> SQLite %d, %d, %d' % (tile.path, z, x, y))
+        if self.bulk:
+            data = tile.data()
+            self.pending[(z, x, y)] = buffer(data)
+            self.pending_bytes += len(data)
+            if self.pending_bytes >= self.buffer_bytes:
+                self.flush()
+            return
         self.dbc.execute('INSERT OR REPLACE INTO maps (zoom, tilex, tiley, pixbuf) VALUES (?, ?, ?, ?);',
             (z, x, y, buffer(tile.data())))
 
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+import hashlib
+
+from converter_backend import *
+
+#############################
+
+class MBTiles(TileSet): # https://github.com/mapbox/mbtiles-spec
+    'MBTiles SQLite database'
+#############################
+    format, ext, input, output = 'mbtiles', '.mbtiles', True, True
+    max_zoom = 30
+
+    # images are stored once, tiles refer to them by their md5
+    create_sql = [
+        'PRAGMA synchronous = OFF;',
+        'CREATE TABLE IF NOT EXISTS map ('
+            'zoom_level INTEGER, '
+            'tile_column INTEGER, '
+            'tile_row INTEGER, '
+            'tile_id TEXT);',
+        'CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);',
+        'CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT);',
+        'CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id);',
+        'CREATE VIEW IF NOT EXISTS tiles AS SELECT '
+            'map.zoom_level AS zoom_level, '
+            'map.tile_column AS tile_column, '
+            'map.tile_row AS tile_row, '
+            'images.tile_data AS tile_data '
+            'FROM map JOIN images ON images.tile_id = map.tile_id;',
+        'CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);',
+        'CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name);',
+    ]
+
+    # a database with a plain tiles table is written as it is
+    plain_sql = [
+        'PRAGMA synchronous = OFF;',
+        'CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);',
+        'CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);',
+        'CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name);',
+    ]
+
+    def __init__(self, *args, **kw_args):
+        super(MBTiles, self).__init__(*args, **kw_args)
+
+        import sqlite3
+
+        if self.options.isDest:
+            self.db = sqlite3.connect(self.root)
+            self.plain = self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tiles';").fetchone() is not None
+            for stmt in (self.plain_sql if self.plain else self.create_sql):
+                self.db.execute(stmt)
+            self.db.commit()
+            self.pending = {} # (zoom, column, row) -> tile_id, the last stored tile wins
+            self.pending_images = {} # tile_id -> data
+            self.pending_bytes = 0
+            self.buffer_bytes = (self.options.db_buffer or 16) << 20
+            self.tile_ext = None
+        else:
+            self.db = self.sqlite_reader(self.root)
+
+    def __iter__(self):
+        # rows are counted upwards as in TMS
+        where, params = self.range_sql(range(self.max_zoom + 1), self.zoom_sql)
+        dbc = self.db.cursor()
+        dbc.execute('SELECT zoom_level, tile_column, (1 << zoom_level) - 1 - tile_row, tile_data FROM tiles' + where,
+            params)
+        for z, x, y, data in dbc:
+            if data:
+                yield PixBufTile((z, x, y), str(data), (z, x, y))
+
+    def zoom_sql(self, zoom, bounds):
+        'condition on the tiles of a zoom in range, see range_sql()'
+        if not bounds:
+            return 'zoom_level = ?', (zoom,)
+        xmin, ymin, xmax, ymax = bounds
+        return ('(zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?)',
+            (zoom, xmin, xmax, 2**zoom - 1 - ymax, 2**zoom - 1 - ymin))
+
+    def store_tile(self, tile):
+        z, x, y = tile.coord()
+        log('%s -> %s:%d, %d, %d' % (tile.path, self.name, z, x, y))
+        try:
+            self.tile_ext = tile.get_ext()
+        except KeyError:
+            return
+
+        data = tile.data()
+        tile_id = hashlib.md5(data).hexdigest()
+        if tile_id not in self.pending_images:
+            self.pending_images[tile_id] = buffer(data)
+            self.pending_bytes += len(data)
+        self.pending[(z, x, 2**z - 1 - y)] = tile_id
+        if self.pending_bytes >= self.buffer_bytes:
+            self.flush()
+
+    def flush(self):
+        'write the buffered tiles in one transaction, an image already in the map/images layout is not written again'
+        if self.plain:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?);',
+                (key + (self.pending_images[self.pending[key]],) for key in sorted(self.pending)))
+        else:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?);',
+                self.pending_images.iteritems())
+            self.db.executemany(
+                'INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?);',
+                (key + (self.pending[key],) for key in sorted(self.pending)))
+        self.db.commit()
+        self.pending = {}
+        self.pending_images = {}
+        self.pending_bytes = 0
+
+    def finalize_tileset(self):
+        self.flush()
+        if not self.plain: # images of the replaced tiles
+            self.db.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map);')
+
+        # extents from finalize_pyramid()
+        zooms = sorted(self.zoom_levels)
+        tl, br = self.pyramid.proj2geog.transform(self.pyramid.raster_corners)
+        metadata = {
+            'name':         self.name,
+            'description':  self.name,
+            'type':         'baselayer',
+            'version':      '1.1',
+            'format':       (self.tile_ext or '.png')[1:].replace('jpeg', 'jpg'),
+            'bounds':       '%.8f,%.8f,%.8f,%.8f' % (tl[0], br[1], br[0], tl[1]),
+            'center':       '%.8f,%.8f,%d' % ((tl[0] + br[0]) / 2, (tl[1] + br[1]) / 2, zooms[0]),
+            'minzoom':      str(zooms[0]),
+            'maxzoom':      str(zooms[-1]),
+            }
+        self.db.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?);', metadata.iteritems())
+        self.db.commit()
+        self.db.close()
+
+tileset_profiles.append(MBTiles)
+
+# MBTiles
@@ -26,6 +26,7 @@
 import binascii
 import time
 import os.path
+import collections
 
 from converter_backend import *
 
@@ -36,6 +37,8 @@ class SASPlanet(TileDir): # http://www.sasgis.org/forum/viewtopic.php?f=2&t=24
 #############################
     format, ext, input, output = 'sasplanet', '.sasplanet', True, True
     dir_pattern = 'z[0-9]*/*/x[0-9]*/*/y[0-9]*.*'
+    path_levels = ((r'z(\d+)$', ('z1',)), (r'(\d+)$', ('x10',)), (r'x(\d+)$', ('x',)),
+        (r'(\d+)$', ('y10',)), (r'y(\d+)\.', ('y',)))
 
     def path2coord(self, tile_path):
         z, dx, x, dy, y = path2list(tile_path)[-6:-1]
@@ -54,6 +57,8 @@ class SASBerkeley(TileDir):
 #############################
     format, ext, input, output = 'sdb', '.sdb', True, False
     dir_pattern = 'z[0-9]*/[0-9]*/[0-9]*/*.sdb'
+    path_levels = ((r'z(\d+)$', ('z1',)), (r'(\d+)$', ('x10',)), (r'(\d+)$', ('y10',)),
+        (r'(\d+)\.(\d+)\.sdb$', ('x8', 'y8')))
 
     def __init__(self, root, options=None):
         super(SASBerkeley, self).__init__(root, options)
@@ -72,33 +77,52 @@ class SASBerkeley(TileDir):
         self.key = struct.Struct('>Q') # 64 bit, swap bytes
 
     def __iter__(self):
-        log('__iter__', os.path.join(self.root, self.dir_pattern), glob.iglob(os.path.join(self.root, self.dir_pattern)))
-        for db_file in glob.iglob(os.path.join(self.root, self.dir_pattern)):
-            log('db_file', db_file)
-            for coord, tile, path in self.iter_tiles(db_file):
-                #~ log('db tile', coord, tile[:20], path)
-                yield PixBufTile(coord, tile, path)
+        for db_file in self.tile_files():
+            for tile in self.iter_shard(db_file):
+                yield tile
+
+    def shards(self):
+        return list(self.tile_files())
+
+    def iter_shard(self, db_file):
+        log('db_file', db_file)
+        for coord, tile, path in self.iter_tiles(db_file):
+            #~ log('db tile', coord, tile[:20], path)
+            yield PixBufTile(coord, tile, path)
 
     def iter_tiles(self, db_path):
         zoom = self.get_zoom(db_path) # also checks data in range
-        if not zoom:
+        if zoom is None:
             return
         d = self.db.DB()
         d.open(db_path, '', self.db.DB_BTREE, self.db.DB_RDONLY)
         c = d.cursor()
-        item = c.first(dlen=0, doff=0)
-        while item:
-            key = item[0]
-            coord = self.get_coord(zoom, key)
-            if self.in_range(coord):
-                data = c.current()[1]
-                tile = self.get_image(data)
-                if tile:
-                    log('tile', coord)
-                    yield coord, tile, [db_path, key]
-            item = c.next(dlen=0, doff=0)
+        # the keys are big-endian Morton codes, so the BTREE order is the Z-order:
+        # seek to the first key of each range of the tiles in range, read on to its last key
+        for first, last in self.key_ranges(db_path, zoom):
+            last_key = self.key.pack(last)
+            item = c.set_range(self.key.pack(first))
+            while item and item[0] <= last_key:
+                key, data = item
+                coord = self.get_coord(zoom, key)
+                if coord:
+                    tile = self.get_image(data)
+                    if tile:
+                        log('tile', coord)
+                        yield coord, tile, [db_path, key]
+                item = c.next()
         d.close()
 
+    def key_ranges(self, db_path, zoom):
+        'Morton ranges of the keys in range out of the 256x256 tiles of a database'
+        xy8 = path2list(db_path)[-2]
+        x_min, y_min = [int(d) << 8 for d in xy8.split('.')]
+        box = [x_min, y_min, x_min | 0xFF, y_min | 0xFF]
+        bounds = self.zoom_bounds(zoom)
+        if bounds:
+            box = [max(box[0], bounds[0]), max(box[1], bounds[1]), min(box[2], bounds[2]), min(box[3], bounds[3])]
+        return morton_ranges(*box)
+
     def get_zoom(self, db_path): # u_TileFileNameBerkeleyDB
         z, x10, y10, xy8 = path2list(db_path)[-5:-1]
         zoom = int(z[1:]) - 1
@@ -114,11 +138,7 @@ class SASBerkeley(TileDir):
     def get_coord(self, zoom, key): # u_BerkeleyDBKey.pas TBerkeleyDBKey.PointToKey
         if key == '\xff\xff\xff\xff\xff\xff\xff\xff':
             return None
-        kxy = self.key.unpack(key)[0] # swaps bytes
-        xy = [0, 0]
-        for bit_n in range(64): # bits for x and y are interleaved in the key
-            x0y1 = bit_n % 2 # x, y
-            xy[x0y1] += (kxy >> bit_n & 1) << (bit_n - x0y1) / 2
+        xy = list(morton_decode(self.key.unpack(key)[0])) # bits for x and y are interleaved in the key
 
         coord = [zoom] + xy
         #~ log('get_coord', coord, zoom, key, hex(kxy), hex(xy[0]), hex(xy[1]))
@@ -131,15 +151,18 @@ class SASBerkeley(TileDir):
             log('get_image', 'wrong magic', magic, magic_v)
             return None
 
-        strings = []
+        strings = [] # UTF-16 strings, zero-terminated
         i = start = self.header.size
-        while True:
-            if data[i] == '\x00':
-                strings.append(data[start: i: 2])
-                start = i + 2
-                if len(strings) == 2:
-                    break
-            i += 2
+        while len(strings) < 2:
+            i = data.find('\x00', i)
+            if i < 0:
+                log('get_image', 'no string terminator')
+                return None
+            if (i - start) % 2: # a high byte
+                i += 1
+                continue
+            strings.append(data[start: i: 2])
+            start = i = i + 2
 
         tile_version, content_type = strings
         tile_data = data[start: start + tile_size]
@@ -158,6 +181,8 @@ class SASSQLite(TileDir):
 #############################
     format, ext, input, output = 'slite', '.sqlitedb', True, True
     dir_pattern = 'z[0-9]*/[0-9]*/[0-9]*/*.sqlitedb'
+    path_levels = ((r'z(\d+)$', ('z1',)), (r'(\d+)$', ('x10',)), (r'(\d+)$', ('y10',)),
+        (r'(\d+)\.(\d+)\.sqlitedb$', ('x8', 'y8')))
 
     # from u_TileStorageSQLiteHolder.pas
     create_sql = [
@@ -176,8 +201,11 @@ class SASSQLite(TileDir):
         'CREATE INDEX IF NOT EXISTS t_v_idx on t (v);'
     ]
 
-    db_path = None
-    db = None
+    insert_sql = ('INSERT OR REPLACE INTO t '
+                    '(x, y, s, h, d, b) '
+                    'VALUES (?, ?, ?, ?, ?, ?);')
+
+    max_open_db = 64 # connections kept open, the least recently used are closed
 
     def __init__(self, *args, **kw_args):
         super(SASSQLite, self).__init__(*args, **kw_args)
@@ -185,22 +213,38 @@ class SASSQLite(TileDir):
         import sqlite3
         self.sqlite3 = sqlite3
 
+        self.connections = collections.OrderedDict() # db path -> connection, in LRU order
+        self.pending = {} # db path -> rows to insert
+        self.pending_bytes = 0
+        self.buffer_bytes = (self.options.db_buffer or 16) << 20
+
     def __iter__(self):
-        log('__iter__', os.path.join(self.root, self.dir_pattern), glob.iglob(os.path.join(self.root, self.dir_pattern)))
-        for db_file in glob.iglob(os.path.join(self.root, self.dir_pattern)):
-            log('db_file', db_file)
-            for tile in self.iter_db_file(db_file):
+        for db_file in self.tile_files():
+            for tile in self.iter_shard(db_file):
                 yield tile
 
+    def shards(self):
+        return list(self.tile_files())
+
+    def iter_shard(self, db_file):
+        log('db_file', db_file)
+        return self.iter_db_file(db_file)
+
     def iter_db_file(self, db_path):
         zoom = self.get_zoom(db_path) # also checks data in range
-        if not zoom:
+        if zoom is None:
             return
 
-        db = self.sqlite3.connect(db_path)
+        where, params = '', ()
+        bounds = self.zoom_bounds(zoom)
+        if bounds: # the region cuts the database's block of tiles
+            xmin, ymin, xmax, ymax = bounds
+            where, params = 'WHERE x BETWEEN ? AND ? AND y BETWEEN ? AND ? ', (xmin, xmax, ymin, ymax)
+
+        db = self.sqlite_reader(db_path)
         dbc = db.cursor()
 
-        dbc.execute('SELECT x, y, MAX(v), b FROM t GROUP BY x,y;')
+        dbc.execute('SELECT x, y, MAX(v), b FROM t %sGROUP BY x,y;' % where, params)
         for x, y, version, data in dbc:
             if data:
                 coord = [zoom, x, y]
@@ -223,6 +267,7 @@ class SASSQLite(TileDir):
         return zoom
 
     def store_tile(self, tile):
+        'buffer a tile by its database file, the buffer is written when full'
         z, x, y = tile.coord()
         data = buffer(tile.data())
         log('%s -> %s:%d, %d, %d' % (tile.path, self.name, z, x, y))
@@ -232,46 +277,53 @@ class SASSQLite(TileDir):
         except KeyError:
             return
 
-        self.set_db(tile)
-
         timestamp = int(time.time())
-        self.dbc.execute(
-            'INSERT OR REPLACE INTO t '
-                '(x, y, s, h, d, b) '
-                'VALUES (?, ?, ?, ?, ?, ?);',
-            (x, y, len(data), binascii.crc32(data) % (1 << 32), timestamp, data)
-        )
-
-    def set_db(self, tile):
+        self.pending.setdefault(self.db_file(tile), []).append(
+            (x, y, len(data), binascii.crc32(data) % (1 << 32), timestamp, data))
+        self.pending_bytes += len(data)
+        if self.pending_bytes >= self.buffer_bytes:
+            self.flush()
+
+    def db_file(self, tile):
         z, x, y = tile.coord()
         db_dir = os.path.join(self.root, 'z' + str(z + 1), str(x >> 10), str(y >> 10))
         db_name = '%d.%d%s' % (x >> 8, y >> 8, self.ext)
-
-        db_path = os.path.join(db_dir, db_name)
-        log(db_path)
-        if self.db_path == db_path:
-            return
-
-        if self.db:
-            self.db.commit()
-            self.db.close()
-
-        if not os.path.exists(db_dir):
-            os.makedirs(db_dir)
-
-        self.db_path = db_path
-        self.db = self.sqlite3.connect(db_path)
-        self.dbc = self.db.cursor()
-
-        for stmt in self.create_sql:
-            self.dbc.execute(stmt)
-        self.db.commit()
+        return os.path.join(db_dir, db_name)
+
+    def connect(self, db_path):
+        'an open connection from the LRU, opens (and creates) a database if needed'
+        db = self.connections.pop(db_path, None)
+        if db is None:
+            log(db_path)
+            if len(self.connections) >= self.max_open_db:
+                old_path, old_db = self.connections.popitem(last=False)
+                old_db.close()
+
+            db_dir = os.path.dirname(db_path)
+            if not os.path.exists(db_dir):
+                os.makedirs(db_dir)
+
+            db = self.sqlite3.connect(db_path)
+            for stmt in self.create_sql:
+                db.execute(stmt)
+            db.commit()
+        self.connections[db_path] = db # most recently used
+        return db
+
+    def flush(self):
+        'write the buffered tiles: a transaction per database, the statement is prepared once per connection'
+        for db_path in sorted(self.pending):
+            db = self.connect(db_path)
+            db.executemany(self.insert_sql, self.pending[db_path])
+            db.commit()
+        self.pending = {}
+        self.pending_bytes = 0
 
     def finalize_tileset(self):
-        if self.db:
-            self.db.commit()
-            self.db.close()
-            self.db = None
+        self.flush()
+        for db in self.connections.values():
+            db.close()
+        self.connections.clear()
 
 tileset_profiles.append(SASSQLite)
 
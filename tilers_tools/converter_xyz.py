@@ -32,6 +32,7 @@ class TMStiles(TileMapDir): # see TileMap Diagram at http://wiki.osgeo.org/wiki/
 #############################
     format, ext, input, output = 'tms', '.tms', True, True
     dir_pattern = '[0-9]*/*/*.*'
+    path_levels = ((r'(\d+)$', ('z',)), (r'(\d+)$', ('x',)), (r'(\d+)\.', ('tms_y',)))
 
     def path2coord(self, tile_path):
         z, x, y = map(int, path2list(tile_path)[-4:-1])
@@ -49,6 +50,7 @@ class XYZtiles(TileMapDir): # http://code.google.com/apis/maps/documentation/jav
 #############################
     format, ext, input, output = 'xyz', '.xyz', True, True
     dir_pattern = '[0-9]*/*/*.*'
+    path_levels = ((r'(\d+)$', ('z',)), (r'(\d+)$', ('x',)), (r'(\d+)\.', ('y',)))
 
     def path2coord(self, tile_path):
         return map(int, path2list(tile_path)[-4:-1])
@@ -64,7 +66,9 @@ class ZYXtiles(TileMapDir):
     'ZYX aka Global Mapper (SASPlanet compatible)'
 #############################
     format, ext, input, output = 'zyx', '.zyx', True, True
+    path_template = 'z%i/%i/%i'
     dir_pattern = 'z[0-9]*/*/*.*'
+    path_levels = ((r'z(\d+)$', ('z',)), (r'(\d+)$', ('y',)), (r'(\d+)\.', ('x',)))
 
     def path2coord(self, tile_path):
         z, y, x = path2list(tile_path)[-4:-1]
@@ -82,6 +86,7 @@ class MapNav(TileDir): # http://mapnav.spb.ru/site/e107_plugins/forum/forum_view
 #############################
     format, ext, input, output = 'mapnav', '.mapnav', True, True
     dir_pattern = 'Z[0-9]*/*/*.pic'
+    path_levels = ((r'Z(\d+)$', ('z',)), (r'(\d+)$', ('y',)), (r'(\d+)\.pic$', ('x',)))
     tile_class = FileTileNoExt
 
     def dest_ext(self, tile):
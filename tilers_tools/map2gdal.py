@@ -35,19 +35,15 @@ from optparse import OptionParser
 from tiler_functions import *
 
 import reader_backend
-import reader_bsb
-import reader_geo
-import reader_ozi
-import reader_kml
 
 options = None
 
 def process_src(src, no_error=False, opt=None):
     """
     if source is converted successfully returns
-        (<generated VRT file>, True)
+        (<generated VRT file>, True, <VRT text if converted in memory, otherwise None>)
     otherwise returns
-        (<source>, False)
+        (<source>, False, None)
     """
     global options
 
@@ -60,19 +56,22 @@ def process_src(src, no_error=False, opt=None):
         lines=[f.readline() for i in range(30)]
 
     err_msg = None
-    for cls in reader_backend.reader_class_map:
-        patt=cls.magic
-        if any((l.startswith(patt) for l in lines)):
-            try:
-                res = [(layer.convert(), True) for layer in cls(src,options=opt).get_layers()]
-                return res
-            except RuntimeError as exc:
-                err_msg = exc.message
-                if not no_error:
-                    raise
+    # import only the readers which recognize the file
+    for cls in reader_backend.reader_class_map.select(
+            lambda patt: any((l.startswith(patt) for l in lines))):
+        try:
+            res = []
+            for layer in cls(src,options=opt).get_layers():
+                dst_file = layer.convert()
+                res.append((dst_file, True, layer.vrt_xml))
+            return res
+        except RuntimeError as exc:
+            err_msg = exc.message
+            if not no_error:
+                raise
     else:
         if no_error:
-            return [(src, False)]
+            return [(src, False, None)]
         if err_msg is None:
             err_msg = '*** %s' % exc.message
         if self.options.skip_invalid:
@@ -41,7 +41,11 @@ except ImportError:
 
 from tiler_functions import *
 
-reader_class_map = []
+reader_class_map = PluginRegistry('magic')
+reader_class_map.register('reader_bsb', 'KNP/')
+reader_class_map.register('reader_geo', '[MainChart]')
+reader_class_map.register('reader_ozi', 'OziExplorer Map Data File')
+reader_class_map.register('reader_kml', '<kml xmlns')
 
 def dms2dec(degs='0',mins='0',ne='E',sec='0'):
     return (float(degs)+float(mins)/60+float(sec)/3600)*(-1 if ne in ('W','S') else 1 )
@@ -190,6 +194,8 @@ class SrcLayer(object):
 
 ###############################################################################
 
+    vrt_xml=None # VRT text if converted in memory
+
     def __init__(self,src_map,data):
         self.map=src_map
         self.data=data
@@ -197,6 +203,8 @@ class SrcLayer(object):
 
         self.img_file=self.get_raster()
         fname = self.img_file.encode(locale.getpreferredencoding())
+        if src_map.options.in_memory: # in-memory VRT can not refer to a relative path
+            fname = os.path.abspath(fname)
 
         self.raster_ds = gdal.Open(fname, GA_ReadOnly)
 
@@ -273,7 +281,7 @@ class SrcLayer(object):
             dst_file = os.path.abspath(os.path.basename(base+ext)) # output file
             dst_drv = gdal.GetDriverByName(out_format)
             dst_ds = dst_drv.CreateCopy(
-                dst_file.encode(locale.getpreferredencoding()),
+                '' if options.in_memory else dst_file.encode(locale.getpreferredencoding()),
                 self.raster_ds,
                 0
             )
@@ -291,6 +299,9 @@ class SrcLayer(object):
             if self.name:
                 dst_ds.SetMetadataItem('DESCRIPTION',self.name.encode('utf-8'))
 
+            if options.in_memory: # hand over VRT text instead of a file
+                self.vrt_xml=dst_ds.GetMetadata('xml:VRT')[0]
+
             dst_ds = None # close dataset
 #            re_sub_file(dst_file, [
 #                    ('^.*<GeoTransform>.*\n',''),
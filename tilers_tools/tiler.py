@@ -27,10 +27,6 @@ from optparse import OptionParser
 
 from tiler_functions import *
 from tiler_backend import Pyramid, resampling_lst, base_resampling_lst
-import tiler_global_mercator
-import tiler_plate_carree
-import tiler_misc
-
 import map2gdal
 
 #~ import rpdb2; rpdb2.start_embedded_debugger('nRAmgJHm')
@@ -48,25 +44,182 @@ def preprocess_src(src):
 
 #----------------------------
 
-def process_src(src_def):
+def make_pyramid(src_def, dest=None):
 
 #----------------------------
     global options
     opt = LooseDict(options)
     opt.tile_format = opt.tile_format.lower()
     opt.tile_ext = '.' + opt.tile_format
-    src, delete_src = src_def
+    src, delete_src, src_xml = src_def
     opt.delete_src = delete_src
+    opt.src_xml = src_xml
 
     profile = Pyramid.profile_class(opt.profile)
-    ext = profile.defaul_ext if opt.strip_dest_ext is None else ''
-    dest = dest_path(src, opt.dest_dir, ext)
+    if dest is None:
+        ext = profile.defaul_ext if opt.strip_dest_ext is None else ''
+        dest = dest_path(src, opt.dest_dir, ext)
+
+    return profile(src, dest, opt)
+
+#----------------------------
+
+def process_src(src_def):
 
-    prm = profile(src, dest, opt)
+#----------------------------
+    prm = make_pyramid(src_def)
     prm.generate_tiles()
 
 #----------------------------
 
+def process_mosaic(src_lst):
+
+#----------------------------
+    prm = make_pyramid((options.mosaic, False, None))
+    prm.generate_mosaic(src_lst)
+
+#----------------------------
+
+def estimate_src(src_def):
+
+#----------------------------
+    src, delete_src, src_xml = src_def
+    prm = make_pyramid((src, False, src_xml))
+    return prm.estimate_cost(cpu_count() * 4)
+
+#----------------------------
+
+def plan_src(src_def):
+
+#----------------------------
+    prm = make_pyramid(src_def)
+    return prm.plan(options.plan_samples)
+
+#----------------------------
+
+def rebuild_overviews(dest):
+
+#----------------------------
+    prm = make_pyramid((dest, False, None), dest.rstrip('/'))
+    try:
+        prm.rebuild_overviews()
+    except RuntimeError as exc:
+        logging.error(exc.message)
+
+#----------------------------
+
+def process_part(task):
+
+#----------------------------
+    src_def, part = task
+    prm = make_pyramid(src_def)
+    return prm.generate_tiles(part)
+
+#----------------------------
+
+def process_scheduled(src_lst, governor=None):
+    '''render the costliest sources first, split the oversized ones into subtrees,
+    so the idle workers pick up the parts of a big source'''
+#----------------------------
+    estimates = parallel_map(estimate_src, src_lst)
+    n_workers = cpu_count()
+    total_cost = sum((est['cost'] for est in estimates if est))
+
+    tasks = []
+    joins = {}
+    for src_def, est in zip(src_lst, estimates):
+        if est is None:
+            continue
+        cost = est['cost']
+        subtrees = est['subtrees']
+        if n_workers < 2 or cost <= float(total_cost) / n_workers or len(subtrees) < 2:
+            tasks.append((cost, (src_def, None)))
+            continue
+
+        # oversized source: render subtrees in parallel, then join them
+        try:
+            make_pyramid(src_def).remove_dest()
+        except RuntimeError as exc:
+            logging.error(exc.message)
+            continue
+        os.makedirs(est['dest'])
+
+        n_tiles = sum(map(len, subtrees))
+        ld('split', est['dest'], est['split_zoom'], len(subtrees), n_tiles)
+        for i, subtree in enumerate(subtrees):
+            fraction = float(len(subtree)) / n_tiles
+            part = {'id': i, 'subtree': subtree, 'fraction': fraction}
+            tasks.append((cost * fraction, ((src_def[0], False, src_def[2]), part)))
+        joins[est['dest']] = [src_def, est['split_zoom'], [], {}]
+
+    tasks.sort(key=lambda t: t[0], reverse=True)
+
+    def merge_results(results):
+        for res in filter(None, results):
+            dest, transparency, top_opacities = res
+            joins[dest][2].extend(top_opacities)
+            joins[dest][3].update(transparency)
+
+    merge_results(parallel_map(process_part, [t for c, t in tasks], chunksize=1,
+        initializer=set_mem_governor, initargs=(governor,)))
+
+    join_tasks = [(src_def, {'id': 'join', 'join': (split_zoom, top_opacities)})
+        for src_def, split_zoom, top_opacities, transparency in joins.values()]
+    merge_results(parallel_map(process_part, join_tasks, chunksize=1,
+        initializer=set_mem_governor, initargs=(governor,)))
+
+    for dest in joins:
+        make_pyramid(joins[dest][0]).write_inventory(joins[dest][3])
+
+#----------------------------
+
+def estimate_zooms(src_def):
+
+#----------------------------
+    src, delete_src, src_xml = src_def
+    prm = make_pyramid((src, False, src_xml))
+    return prm.estimate_zooms()
+
+#----------------------------
+
+def process_zooms(src_lst, governor=None):
+    '''warp every zoom level on its own from the closest source overview,
+    so zoom levels render in parallel and the lowest ones are ready first'''
+#----------------------------
+    estimates = parallel_map(estimate_zooms, src_lst)
+
+    tasks = []
+    joins = {}
+    for src_def, est in zip(src_lst, estimates):
+        if est is None:
+            continue
+        try:
+            make_pyramid(src_def).remove_dest()
+        except RuntimeError as exc:
+            logging.error(exc.message)
+            continue
+        os.makedirs(est['dest'])
+
+        n_tiles = sum(est['zooms'].values())
+        for zoom, zoom_tiles in est['zooms'].items():
+            part = {'id': 'z%d' % zoom, 'zoom': zoom, 'fraction': float(zoom_tiles) / n_tiles}
+            tasks.append((zoom, ((src_def[0], False, src_def[2]), part)))
+        joins[est['dest']] = [src_def, {}]
+
+    tasks.sort(key=lambda t: t[0])
+
+    for res in filter(None, parallel_map(process_part, [t for z, t in tasks], chunksize=1,
+            initializer=set_mem_governor, initargs=(governor,))):
+        dest, transparency, top_opacities = res
+        joins[dest][1].update(transparency)
+
+    join_tasks = [(src_def, {'id': 'join', 'zooms': transparency})
+        for src_def, transparency in joins.values()]
+    parallel_map(process_part, join_tasks, chunksize=1,
+        initializer=set_mem_governor, initargs=(governor,))
+
+#----------------------------
+
 def parse_args(arg_lst):
 
 #----------------------------
@@ -115,6 +268,8 @@ def parse_args(arg_lst):
         help='prefix for tile URLs at googlemaps.hml')
     parser.add_option("--tile-format", default='png', metavar="FMT",
         help='tile image format (default: png)')
+    parser.add_option("--output", action="append", default=None, metavar="PROFILE:FORMAT[:SCALE]",
+        help='also write the tiles in another layout and format, SCALE times larger (same warp; may be repeated)')
     parser.add_option("--paletted", action="store_true",
         help='convert tiles to paletted format (8 bit/pixel)')
     parser.add_option("-t", "--dest-dir", dest="dest_dir", default=None,
@@ -137,6 +292,30 @@ def parse_args(arg_lst):
         help='give an output file name  after name of a map file, otherwise after a name of an image file')
     parser.add_option("--skip-invalid", action="store_true",
         help='skip invalid/unrecognized source')
+    parser.add_option("--in-memory", action="store_true",
+        help='pass intermediate VRTs between processing stages in memory instead of files')
+    parser.add_option("--src-cache", default=None, metavar="DIR",
+        help='keep decoded copies of the sources in DIR and warp from them (for BSB, OZF, compressed TIFF)')
+    parser.add_option("--src-cache-size", type="int", default=4096, metavar="MB",
+        help='source cache size limit, the least recently used copies are evicted (default: 4096)')
+    parser.add_option("--kml-block", type="int", default=None, metavar="N",
+        help='geo profiles: pack KML regions into a file per block of NxN tiles instead of a file per tile')
+    parser.add_option("--plan", action="store_true",
+        help='print an estimate of tiles, disk space and time per zoom in JSON, do not generate tiles')
+    parser.add_option("--plan-samples", type="int", default=16, metavar="N",
+        help='number of base zoom tiles to render for the estimate (default: 16)')
+    parser.add_option("--rebuild-overviews", action="store_true",
+        help='sources are existing pyramids: regenerate their overview zooms from the base zoom tiles')
+    parser.add_option("--mosaic", default=None, metavar="NAME",
+        help='tile all the sources into a single pyramid NAME; the first sources are on top')
+    parser.add_option("--src-overviews", action="store_true",
+        help='warp each zoom level from the closest source overview (built if missing), render zoom levels in parallel')
+    parser.add_option("--schedule", action="store_true",
+        help='start from the largest sources, split the oversized ones between workers')
+    parser.add_option("--prefetch", type="int", default=None, metavar="MB",
+        help='read base tiles ahead in a thread while the tiles are encoded, using up to MB of memory')
+    parser.add_option("--mem-budget", type="int", default=None, metavar="MB",
+        help='memory budget for GDAL caches and warp buffers shared by all worker processes')
 
     (options, args) = parser.parse_args(arg_lst)
 
@@ -168,11 +347,31 @@ def main(argv):
     if options.verbose == 2:
         set_nothreads()
 
+    if options.output and (options.schedule or options.src_overviews or options.rebuild_overviews):
+        logging.error('--output works with a single part rendering only')
+        sys.exit(1)
+
     if options.release:
         options.overview_resampling, options.base_resampling = ('antialias', 'cubic')
 
+    governor = MemoryGovernor(options.mem_budget) if options.mem_budget else None
+
+    if options.rebuild_overviews:
+        parallel_map(rebuild_overviews, args, initializer=set_mem_governor, initargs=(governor,))
+        return
+
     res = parallel_map(preprocess_src, args)
-    parallel_map(process_src, flatten(res))
+    if options.plan:
+        print(json.dumps(filter(None, parallel_map(plan_src, flatten(res))), indent=2, sort_keys=True))
+    elif options.mosaic:
+        set_mem_governor(governor)
+        process_mosaic(flatten(res))
+    elif options.src_overviews:
+        process_zooms(flatten(res), governor)
+    elif options.schedule:
+        process_scheduled(flatten(res), governor)
+    else:
+        parallel_map(process_src, flatten(res), initializer=set_mem_governor, initargs=(governor,))
 
 # main()
 
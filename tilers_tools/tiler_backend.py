@@ -29,6 +29,15 @@ import os.path
 import shutil
 import math
 import cgi
+import tempfile
+import glob
+import hashlib
+import weakref
+import random
+import time
+import StringIO
+import threading
+import Queue
 from PIL import Image
 
 try:
@@ -44,9 +53,13 @@ except ImportError:
     from gdalconst import *
 
 from tiler_functions import *
-import map2gdal
+import tiler_functions
+from tiler_inventory import TileInventory
 
-profile_map = []
+profile_map = PluginRegistry('profile')
+profile_map.register('tiler_global_mercator', 'zyx', 'xyz', 'tms')
+profile_map.register('tiler_plate_carree', 'geo', 'xyz-geo', 'tms-geo')
+profile_map.register('tiler_misc', 'generic', 'wgs84')
 
 resampling_map = {
     'near':     Image.NEAREST,
@@ -77,6 +90,7 @@ class TilingScheme(object):
     tile_origin_corner = 'tl'
     tile_size = (256, 256)
     axis_inv = (1, -1) # y goes downwards
+    path_template = '%i/%i/%i' # numbers of a tile path, see TileInventory
 
     #----------------------------
 
@@ -95,10 +109,18 @@ class TilingScheme(object):
         z, x, y = self.normalize_tile(tile)
         return '%i/%i/%i%s' % (z, x, y, self.tile_ext)
 
+    #----------------------------
+
+    def path_tile(self, numbers):
+        'tile from the numbers of its path, the inverse of tile_path()'
+    #----------------------------
+        return self.normalize_tile(numbers)
+
 class XYZtiling(TilingScheme):
     pass
 
 class ZYXtiling(XYZtiling):
+    path_template = 'z%i/%i/%i'
 
     #----------------------------
 
@@ -108,6 +130,14 @@ class ZYXtiling(XYZtiling):
         z, x, y = self.normalize_tile(tile)
         return 'z%i/%i/%i%s' % (z, y, x, self.tile_ext)
 
+    #----------------------------
+
+    def path_tile(self, numbers):
+        'tile from the numbers of its path, the inverse of tile_path()'
+    #----------------------------
+        z, y, x = numbers
+        return self.normalize_tile((z, x, y))
+
 class TMStiling(TilingScheme):
     axis_inv = (1, 1)
     tile_origin_corner = 'bl'
@@ -123,9 +153,90 @@ class TMStiling(TilingScheme):
 
 #############################
 
+class Prefetcher(threading.Thread):
+    '''reads base tiles ahead of the rendering, in the order of the tile tree traversal;
+    GDAL releases the GIL while it reads and warps, so encoding goes on meanwhile'''
+#############################
+
+    def __init__(self, base_img, tiles, pixcorners, max_tiles):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.base_img = base_img
+        self.tiles = tiles
+        self.pixcorners = pixcorners
+        self.ready = Queue.Queue(max(1, max_tiles)) # bounds the memory taken by read tiles
+        self.stopped = False
+        self.done = False
+        self.start()
+
+    def run(self):
+        try:
+            for tile in self.tiles:
+                if self.stopped:
+                    return
+                self.ready.put((tile, self.base_img.get_tile(self.pixcorners(tile)), None))
+        except Exception as exc:
+            self.ready.put((None, None, exc))
+        self.ready.put((None, None, None))
+
+    def get_tile(self, tile):
+        'the next base tile, tiles are requested in the order they were read'
+        while not self.done:
+            ready_tile, result, exc = self.ready.get()
+            if exc is not None:
+                raise exc
+            if ready_tile is None:
+                self.done = True
+            elif ready_tile == tile:
+                return result
+            else:
+                ld('prefetch skipped', ready_tile, tile)
+        # the reader has finished: safe to read in this thread
+        return self.base_img.get_tile(self.pixcorners(tile))
+
+    def close(self):
+        self.stopped = True
+        while self.is_alive():
+            try:
+                self.ready.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+# Prefetcher
+
+#############################
+
+class BufferPool(object):
+    '''reusable pixel buffers of the same size'''
+#############################
+    max_free = 64
+
+    def __init__(self, size):
+        self.size = size
+        self.free = []
+        self.refs = set()
+
+    def get(self):
+        return self.free.pop() if self.free else bytearray(self.size)
+
+    def put(self, buf):
+        if len(self.free) < self.max_free:
+            self.free.append(buf)
+
+    def attach(self, img, buf):
+        'return a buffer to the pool as soon as an image sharing it is gone'
+        def release(ref):
+            self.refs.discard(ref)
+            self.put(buf)
+        self.refs.add(weakref.ref(img, release))
+# BufferPool
+
+#############################
+
 class BaseImg(object):
     '''Tile feeder for a base zoom level'''
 #############################
+    tiles_exist = False
+    buf_obj = True # bindings can read into a buffer
 
     def __init__(self, dataset, tl_offsets, transparency=None):
         self.ds = dataset
@@ -134,11 +245,38 @@ class BaseImg(object):
 
         self.size = self.ds.RasterXSize, self.ds.RasterYSize
         self.bands = [self.ds.GetRasterBand(i + 1) for i in range(self.ds.RasterCount)]
+        self.band_list = range(1, self.ds.RasterCount + 1)
+        self.pools = {}
 
     def __del__(self):
         del self.bands
         del self.ds
 
+    def covers(self, tile):
+        return True
+
+    def read_pixels(self, tl, sz):
+        'read all the bands at once into a pixel-interleaved buffer'
+        n_bands = len(self.band_list)
+        nbytes = sz[0] * sz[1] * n_bands
+        pool = self.pools.get(nbytes)
+        if pool is None:
+            pool = self.pools[nbytes] = BufferPool(nbytes)
+
+        interleave = dict(
+            band_list=self.band_list,
+            buf_pixel_space=n_bands,
+            buf_line_space=n_bands * sz[0],
+            buf_band_space=1,
+            )
+        if self.buf_obj:
+            try:
+                return self.ds.ReadRaster(tl[0], tl[1], sz[0], sz[1], sz[0], sz[1], GDT_Byte,
+                    buf_obj=pool.get(), **interleave), pool
+            except TypeError: # older bindings always allocate a new buffer
+                BaseImg.buf_obj = False
+        return self.ds.ReadRaster(tl[0], tl[1], sz[0], sz[1], sz[0], sz[1], GDT_Byte, **interleave), None
+
     def get_tile(self, corners):
         '''crop raster as per pair of world pixel coordinates'''
 
@@ -147,35 +285,216 @@ class BaseImg(object):
 
         #~ ld('get_tile', tl, sz)
 
-        tile_bands = [bnd.ReadRaster(tl[0], tl[1], sz[0], sz[1], sz[0], sz[1], GDT_Byte)
-                    for bnd in self.bands]
-        n_bands = len(self.bands)
+        pixels, pool = self.read_pixels(tl, sz)
+        shared = True # the image is a view of the buffer
+        n_bands = len(self.band_list)
         if n_bands == 1:
             opacity = 1
-            mode = 'L'
             if self.transparency is not None:
-                if chr(self.transparency) in tile_bands[0]:
-                    colorset = set(tile_bands[0])
-                    if len(colorset) == 1:  # fully transparent
-                        return None, 0
+                transparent = chr(self.transparency)
+                if transparent in pixels:
+                    if not pixels.strip(transparent): # fully transparent
+                        img = None
+                        opacity = 0
                     else:                   # semi-transparent
                         opacity = -1
-            img = Image.frombuffer('L', sz, tile_bands[0], 'raw', 'L', 0, 1)
+            if opacity != 0:
+                img = Image.frombuffer('L', sz, pixels, 'raw', 'L', 0, 1)
         else:
-            aplpha = tile_bands[-1]
-            if min(aplpha) == '\xFF':       # fully opaque
+            aplpha = pixels[n_bands - 1::n_bands]
+            if not aplpha.strip('\xFF'):       # fully opaque
                 opacity = 1
-                tile_bands = tile_bands[:-1]
-                mode = 'RGB' if n_bands > 2 else 'L'
-            elif max(aplpha) == '\x00':     # fully transparent
-                return None, 0
+                shared = False
+                if n_bands > 2:
+                    img = Image.frombuffer('RGB', sz, pixels, 'raw', 'RGBX', 0, 1)
+                else:
+                    img = Image.frombuffer('LA', sz, pixels, 'raw', 'LA', 0, 1).convert('L')
+            elif not aplpha.strip('\x00'):     # fully transparent
+                img = None
+                opacity = 0
             else:                           # semi-transparent
                 opacity = -1
-                mode = 'RGBA' if n_bands > 2 else 'LA'
-            img = Image.merge(mode, [Image.frombuffer('L', sz, bnd, 'raw', 'L', 0, 1) for bnd in tile_bands])
+                if n_bands > 2:
+                    img = Image.frombuffer('RGBA', sz, pixels, 'raw', 'RGBA', 0, 1)
+                else:
+                    shared = False
+                    img = Image.frombuffer('LA', sz, pixels, 'raw', 'LA', 0, 1)
+
+        if pool is not None:
+            if img is not None and shared:
+                pool.attach(img, pixels)
+            else:
+                pool.put(pixels)
         return img, opacity
 # BaseImg
 
+#############################
+
+class PyramidImg(object):
+    '''Tile feeder from a zoom level of an existing pyramid'''
+#############################
+    tiles_exist = True
+
+    def __init__(self, pyramid, zoom, opacities):
+        self.pyramid = pyramid
+        self.zoom = zoom
+        self.opacities = dict(((tuple(tile), opc) for tile, opc in opacities))
+
+        # ancestors of the existing tiles: lets skip empty branches
+        self.parents = set()
+        for z, x, y in self.opacities:
+            for dz in range(1, z + 1):
+                self.parents.add((z - dz, x >> dz, y >> dz))
+
+    def covers(self, tile):
+        zoom = tile[0]
+        return tuple(tile) in self.opacities if zoom == self.zoom else (
+            zoom > self.zoom or tuple(tile) in self.parents)
+
+    def get_tile(self, corners):
+        '''read a tile as per pair of world pixel coordinates'''
+
+        tile = tuple(self.pyramid.pix2tile(self.zoom, corners[0]))
+        opacity = self.opacities.get(tile, 0)
+        if opacity == 0:
+            return None, 0
+        img = Image.open(os.path.join(self.pyramid.dest, self.pyramid.tile_path(tile)))
+        img.load()
+        return img, opacity
+# PyramidImg
+
+#############################
+
+class MosaicImg(object):
+    '''Tile feeder for a base zoom level from a few sources, the first ones are on top'''
+#############################
+    tiles_exist = False
+
+    def __init__(self, layers):
+        self.layers = layers # BaseImg list
+
+    def covers(self, tile):
+        return True
+
+    def get_tile(self, corners):
+        '''crop and combine the sources which overlap a pair of world pixel coordinates'''
+
+        images = []
+        for layer in self.layers:
+            layer_br = [layer.tl_offsets[c] + layer.size[c] for c in (0, 1)]
+            if any((corners[0][c] >= layer_br[c] or corners[1][c] <= layer.tl_offsets[c] for c in (0, 1))):
+                continue # outside of the source footprint
+            img, opacity = layer.get_tile(corners)
+            if opacity == 0:
+                continue
+            if opacity == 1 and not images: # nothing is over it
+                return img, 1
+            images.append(img)
+            if opacity == 1: # nothing is seen under it
+                break
+
+        if not images:
+            return None, 0
+        if len(images) == 1:
+            return images[0], -1
+
+        tile_img = images.pop().convert('RGBA')
+        for img in reversed(images):
+            tile_img = Image.alpha_composite(tile_img, img.convert('RGBA'))
+
+        if tile_img.split()[-1].getextrema()[0] == 255:
+            return tile_img.convert('RGB'), 1
+        return tile_img, -1
+# MosaicImg
+
+#############################
+
+class SourceCache(object):
+    '''decoded sources kept as uncompressed tiled GeoTIFFs, the least recently used are evicted'''
+#############################
+    creation_options = [
+        'TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256',
+        'INTERLEAVE=PIXEL', 'COMPRESS=NONE', 'BIGTIFF=IF_SAFER',
+        ]
+
+    def __init__(self, cache_dir, size_mb):
+        self.cache_dir = cache_dir
+        self.max_size = size_mb << 20
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError: # created by another process
+                pass
+        # let GDAL memory map uncompressed rasters
+        gdal.SetConfigOption('GTIFF_VIRTUAL_MEM_IO', 'IF_ENOUGH_RAM')
+
+    def key(self, src_ds, src_xml=None):
+        'hash of the source definition and of the raster files size and mtime'
+        h = hashlib.sha1()
+        for fname in src_ds.GetFileList() or []:
+            if fname.startswith('/vsimem/'):
+                h.update(src_xml or fname)
+            elif fname.lower().endswith('.vrt'):
+                with open(fname, 'rb') as f:
+                    h.update(f.read())
+            else:
+                try:
+                    st = os.stat(fname)
+                    h.update('%s %d %d' % (fname, st.st_size, st.st_mtime))
+                except OSError: # GDAL virtual file system
+                    h.update(fname)
+        return h.hexdigest()
+
+    def get(self, src_ds, src_xml=None):
+        'returns a path of a decoded copy of the source, creates it if not cached yet'
+        path = os.path.join(self.cache_dir, self.key(src_ds, src_xml) + '.tif')
+        if os.path.exists(path):
+            ld('src cache hit', path)
+            os.utime(path, None) # mark as recently used
+            return path
+
+        ld('src cache miss', path)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        gtiff_drv = gdal.GetDriverByName('GTiff')
+        cache_ds = gtiff_drv.CreateCopy(tmp, src_ds, 0, self.creation_options)
+        cache_ds = None # flush
+        for ext in ('.aux.xml', ''): # the copy is complete for other processes
+            if not os.path.exists(tmp + ext):
+                continue
+            try:
+                os.rename(tmp + ext, path + ext)
+            except OSError: # Windows: another process has cached it meanwhile
+                if not os.path.exists(path + ext):
+                    raise
+                os.remove(tmp + ext)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        'delete the least recently used copies over the size limit'
+        cached = []
+        for fname in glob.glob(os.path.join(self.cache_dir, '*.tif')):
+            try:
+                st = os.stat(fname)
+                cached.append((st.st_mtime, st.st_size, fname))
+            except OSError: # evicted by another process
+                pass
+        total = sum((size for mtime, size, fname in cached))
+        for mtime, size, fname in sorted(cached):
+            if total <= self.max_size:
+                break
+            if fname == keep:
+                continue
+            ld('src cache evict', fname)
+            for f in (fname, fname + '.aux.xml', fname + '.ovr'):
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+            total -= size
+# SourceCache
+
 
 #############################
 
@@ -187,6 +506,10 @@ class Pyramid(object):
 
     palette = None
     transparency = None
+    base_img = None
+    mosaic = None
+    outputs = []
+    prefetcher = None
     zoom_range = None
     min_res = None
     max_extent = None
@@ -204,6 +527,10 @@ class Pyramid(object):
         self.temp_files = []
         self.src = src
         self.dest = dest
+        self.temp_dir = dest
+        self.temp_suffix = ''
+        self.new_dest = True
+        self.part = {}
         ld('src dest',src, dest)
         self.options = LooseDict(options)
         self.name = self.options.name
@@ -227,7 +554,7 @@ class Pyramid(object):
         try:
             if self.options.verbose < 2:
                 for f in self.temp_files:
-                    os.remove(f)
+                    remove_file(f)
         except: pass
 
     #----------------------------
@@ -255,20 +582,21 @@ class Pyramid(object):
         self.src_dir, src_f = os.path.split(self.src)
         self.base = os.path.splitext(src_f)[0]
 
-        if self.options.delete_src:
+        if self.options.delete_src and not self.options.src_xml:
             self.temp_files.append(self.src)
 
-        if os.path.isdir(self.dest):
-            if self.options.noclobber and os.path.exists(self.dest):
-                raise RuntimeError('Target already exists: skipping')
-            else:
-                shutil.rmtree(self.dest, ignore_errors=True)
+        if self.new_dest:
+            self.remove_dest()
 
         self.base_resampling = base_resampling_map[self.options.base_resampling]
         self.resampling = resampling_map[self.options.overview_resampling]
 
         self.src_path = self.src
-        if os.path.exists(self.src):
+        if self.options.src_xml: # the source is handed over in memory
+            self.src_path = self.temp_path('.vrt')
+            self.temp_files.append(self.src_path)
+            write_file(self.src_path, self.options.src_xml)
+        elif os.path.exists(self.src):
             self.src_path = os.path.abspath(self.src)
             #~ pf('')
             ld('self.src_path',self.src_path, self.src)
@@ -277,13 +605,40 @@ class Pyramid(object):
         self.src_ds = gdal.Open(self.src_path, GA_ReadOnly)
         self.description = self.src_ds.GetMetadataItem('DESCRIPTION')
 
+        if self.options.src_cache and 'join' not in self.part: # warp from a decoded copy of the source
+            src_cache = SourceCache(self.options.src_cache, self.options.src_cache_size)
+            self.src_path = src_cache.get(self.src_ds, self.options.src_xml)
+            self.src_ds = gdal.Open(self.src_path, GA_ReadOnly)
+
         # source is successfully opened, then create destination dir
-        os.makedirs(self.dest)
+        if self.new_dest:
+            os.makedirs(self.dest)
 
+        self.raster_path = self.src_path # before it's wrapped into VRTs
         self.modify_src_raster()
 
     #----------------------------
 
+    def remove_dest(self):
+        'clean up the destination for a new pyramid'
+    #----------------------------
+        if os.path.isdir(self.dest):
+            if self.options.noclobber and os.path.exists(self.dest):
+                raise RuntimeError('Target already exists: skipping')
+            else:
+                shutil.rmtree(self.dest, ignore_errors=True)
+
+    #----------------------------
+
+    def temp_path(self, ext):
+        'auxilary file path'
+    #----------------------------
+        if self.options.in_memory:
+            return '/vsimem/tiler/%d/%s%s%s' % (os.getpid(), self.base, self.temp_suffix, ext)
+        return os.path.abspath(os.path.join(self.temp_dir, self.base + self.temp_suffix + ext))
+
+    #----------------------------
+
     def modify_src_raster(self):
         'convert to RGB(A) if required'
     #----------------------------
@@ -294,7 +649,8 @@ class Pyramid(object):
         band1 = self.src_ds.GetRasterBand(1)
         if src_bands == 1 and band1.GetColorInterpretation() == GCI_PaletteIndex : # source is a paletted raster
             transparency = None
-            if self.base_resampling == 'NearestNeighbour' and self.resampling == Image.NEAREST :
+            if (self.base_resampling == 'NearestNeighbour' and self.resampling == Image.NEAREST and
+                    self.mosaic is None): # sources of a mosaic can't share a palette
                 # check if src can be rendered in paletted mode
                 color_table = band1.GetColorTable()
                 ncolors = color_table.GetCount()
@@ -376,23 +732,22 @@ class Pyramid(object):
                     'band_list':band_lst,
                     }
 
-                src_vrt = os.path.abspath(os.path.join(self.dest, self.base+'.src.vrt')) # auxilary VRT file
+                src_vrt = self.temp_path('.src.vrt') # auxilary VRT file
 
                 self.temp_files.append(src_vrt)
                 self.src_path = src_vrt
-                with open(src_vrt, 'w') as f:
-                    f.write(vrt_txt.encode('utf-8'))
+                write_file(src_vrt, vrt_txt.encode('utf-8'))
 
                 self.src_ds = gdal.Open(src_vrt, GA_ReadOnly)
                 # finished with a paletted raster
 
         if override_srs is not None: # src SRS needs to be relpaced
-            src_vrt = os.path.join(self.dest, self.base+'.src.vrt') # auxilary VRT file
+            src_vrt = self.temp_path('.src.vrt') # auxilary VRT file
             self.temp_files.append(src_vrt)
             self.src_path = src_vrt
 
             vrt_drv = gdal.GetDriverByName('VRT')
-            self.src_ds = vrt_drv.CreateCopy(src_vrt, src_ds) # replace src dataset
+            self.src_ds = vrt_drv.CreateCopy(src_vrt, self.src_ds) # replace src dataset
 
             ld('override_srs', override_srs, 'txt2wkt(override_srs)', txt2wkt(override_srs))
             self.src_ds.SetProjection(txt2wkt(override_srs)) # replace source SRS
@@ -416,12 +771,7 @@ class Pyramid(object):
 
         ld('max raster', self.raster_corners, self.proj2geog.transform(self.raster_corners))
         # self.raster_corners were set to the max raster, now clip them to the max tileset area
-        self.raster_corners = (
-            (max(self.raster_corners[0][0], target_corners[0][0]),
-                min(self.raster_corners[0][1], target_corners[0][1])),
-            (min(self.raster_corners[1][0], target_corners[1][0]),
-                max(self.raster_corners[1][1], target_corners[1][1]))
-            )
+        self.raster_corners = self.clip_corners(target_corners)
 
         ld('target_corners', target_corners, self.proj2geog.transform(target_corners))
         ld('target raster', self.raster_corners, self.proj2geog.transform(self.raster_corners))
@@ -430,17 +780,30 @@ class Pyramid(object):
 
     #----------------------------
 
-    def calc_zoom(self, corners):
+    def clip_corners(self, corners):
+        'intersection of corners with the raster corners'
+    #----------------------------
+        return (
+            (max(self.raster_corners[0][0], corners[0][0]),
+                min(self.raster_corners[0][1], corners[0][1])),
+            (min(self.raster_corners[1][0], corners[1][0]),
+                max(self.raster_corners[1][1], corners[1][1]))
+            )
+
+    #----------------------------
+
+    def calc_zoom(self, corners, max_zoom=None):
         'determine and set a list of zoom levels to generate'
     #----------------------------
 
         # check raster parameters to find default zoom range
         ld('automatic zoom levels')
 
-        auto_warp_res = self.auto_warp_res(corners)
-        ld('auto_warp_corners', corners, 'auto_warp_res', auto_warp_res)
+        if max_zoom is None:
+            auto_warp_res = self.auto_warp_res(corners)
+            ld('auto_warp_corners', corners, 'auto_warp_res', auto_warp_res)
 
-        max_zoom = max(self.res2zoom_xy(auto_warp_res))
+            max_zoom = max(self.res2zoom_xy(auto_warp_res))
 
         tl = corners[0]
         br = corners[1]
@@ -512,27 +875,107 @@ class Pyramid(object):
 
     #----------------------------
 
+        # create base_image raster
+        self.base_img = self.create_base_img()
+        self.set_block_cache()
+
+        # close source dataset
+        del self.src_ds
+
+    #----------------------------
+
+    subtree_tiles = 16 # base tiles along a side of a subtree which is read at once
+    max_block_cache = 1 << 30
+
+    def set_block_cache(self):
+        '''let the GDAL block cache hold the source blocks under two subtrees of the traversal:
+        the neighbour subtree shares the blocks along their border'''
+    #----------------------------
+        if tiler_functions.mem_governor or gdal.GetConfigOption('GDAL_CACHEMAX'):
+            return # sized by the memory governor or by the user
+
+        src_res = self.auto_warp_res(self.auto_warp_corners())[0]
+        res = self.zoom2res(self.max_zoom)[0]
+        tile_src_pixels = (self.tile_size[0] * res / src_res) * (self.tile_size[1] * res / src_res)
+        tile_bytes = tile_src_pixels * self.src_ds.RasterCount + self.tile_size[0] * self.tile_size[1] * 4
+        working_set = 2 * self.subtree_tiles ** 2 * tile_bytes
+        cache = int(min(working_set, self.max_block_cache))
+        ld('set_block_cache', cache, gdal.GetCacheMax())
+        if cache > gdal.GetCacheMax():
+            gdal.SetCacheMax(cache)
+
+    #----------------------------
+
+    def create_base_img(self, corners=None, zoom=None, overview=None):
+        'warp the source (or its overview) into a base zoom raster'
+    #----------------------------
+        if zoom is None:
+            zoom = self.max_zoom
+
         # adjust raster extents to tile boundaries
-        tile_tl, tile_br = self.corner_tiles(self.max_zoom)
+        tile_tl, tile_br = self.corner_tiles(zoom, corners)
         size = ((tile_br[1] - tile_tl[1] + 1) * self.tile_size[0], (tile_br[2] - tile_tl[2] + 1) * self.tile_size[1])
         top_left_coord = self.tile_corners(tile_tl)[0]
-        res = self.zoom2res(self.max_zoom)
+        res = self.zoom2res(zoom)
 
         ld('base_raster', 'tile_tl', tile_tl, 'tile_br', tile_br, 'top_left_coord', top_left_coord, 'res', res, 'size', size)
 
         # warp base raster
-        base_ds = self.create_warped_vrt(top_left_coord, res, size)
-
-        # close source dataset
-        del self.src_ds
+        base_ds = self.create_warped_vrt(top_left_coord, res, size, overview)
 
         tl_pix = self.tile_pixcorners(tile_tl)[0]
-        # create base_image raster
-        self.base_img = BaseImg(base_ds, tl_pix, self.transparency)
+        return BaseImg(base_ds, tl_pix, self.transparency)
 
     #----------------------------
 
-    def create_warped_vrt(self, top_left_coord, res, size):
+    def build_overviews(self):
+        'create source overviews unless the source has some already'
+    #----------------------------
+        ovr_ds = gdal.Open(self.raster_path, GA_ReadOnly)
+        if ovr_ds.GetDriver().ShortName == 'VRT':
+            # a VRT uses the overviews of the raster it refers to
+            rasters = [f for f in (ovr_ds.GetFileList() or [])[1:] if not f.lower().endswith('.vrt')]
+            if len(rasters) != 1:
+                ld('no overviews for', self.raster_path)
+                return
+            ovr_ds = gdal.Open(rasters[0], GA_ReadOnly)
+
+        band = ovr_ds.GetRasterBand(1)
+        if band.GetOverviewCount() > 0:
+            return
+        levels = []
+        factor = 2
+        while min(ovr_ds.RasterXSize, ovr_ds.RasterYSize) // factor >= min(self.tile_size):
+            levels.append(factor)
+            factor *= 2
+        if not levels:
+            return
+        resampling = 'NEAREST' if band.GetRasterColorTable() else 'AVERAGE'
+        ld('build_overviews', ovr_ds.GetFileList()[0], resampling, levels)
+        ovr_ds.BuildOverviews(resampling, levels) # read-only dataset: into an external .ovr
+
+    #----------------------------
+
+    def select_overview(self, zoom):
+        '''the coarsest source overview which is still finer than a zoom level:
+        (overview level, x scale, y scale) or None for the full resolution'''
+    #----------------------------
+        src_res = self.auto_warp_res(self.auto_warp_corners())[0]
+        res = self.zoom2res(zoom)[0]
+        band = self.src_ds.GetRasterBand(1)
+        best = None
+        for i in range(band.GetOverviewCount()):
+            ovr = band.GetOverview(i)
+            fx = float(self.src_ds.RasterXSize) / ovr.XSize
+            fy = float(self.src_ds.RasterYSize) / ovr.YSize
+            if max(fx, fy) * src_res <= res and (best is None or fx > best[1]):
+                best = (i, fx, fy)
+        ld('select_overview', zoom, best)
+        return best
+
+    #----------------------------
+
+    def create_warped_vrt(self, top_left_coord, res, size, overview=None):
 
     #----------------------------
 
@@ -541,14 +984,20 @@ class Pyramid(object):
         src_proj = txt2proj4(self.src_ds.GetProjection())
         gcp_proj = None
 
+        # source pixels are scaled down at an overview
+        ovr_level, fx, fy = overview if overview else (None, 1, 1)
+
         if not self.options.tps and src_geotr and src_geotr != (0.0, 1.0, 0.0, 0.0, 0.0, 1.0):
+            src_geotr = (
+                src_geotr[0], src_geotr[1] * fx, src_geotr[2] * fy,
+                src_geotr[3], src_geotr[4] * fx, src_geotr[5] * fy)
             src_igeotr = gdal.InvGeoTransform(src_geotr)
             src_transform = '%s\n%s' % (warp_src_geotr % src_geotr, warp_src_igeotr % src_igeotr)
         else:
             gcps = self.src_ds.GetGCPs()
             assert gcps, 'Neither geotransform, nor gpcs are in the source file %s' % self.src
 
-            gcp_lst = [(g.Id, g.GCPPixel, g.GCPLine, g.GCPX, g.GCPY, g.GCPZ) for g in gcps]
+            gcp_lst = [(g.Id, g.GCPPixel / fx, g.GCPLine / fy, g.GCPX, g.GCPY, g.GCPZ) for g in gcps]
             ld('src_proj', self.src_ds.GetProjection(), 'gcp_proj', self.src_ds.GetGCPProjection())
             gcp_proj = txt2proj4(self.src_ds.GetGCPProjection())
             if src_proj and gcp_proj != src_proj:
@@ -585,10 +1034,13 @@ class Pyramid(object):
             cut_wkt = self.get_cutline()
         else:
             cut_wkt = None
+        if cut_wkt and overview: # the cut line is in source pixels
+            cut_wkt = re.sub(r'([-+.0-9eE]+) ([-+.0-9eE]+)',
+                lambda m: '%r %r' % (float(m.group(1)) / fx, float(m.group(2)) / fy), cut_wkt)
         if cut_wkt:
             warp_options.append(w_option('CUTLINE', cut_wkt))
             if self.options.blend_dist:
-                warp_options.append(w_option('CUTLINE_BLEND_DIST', self.options.blend_dist))
+                warp_options.append(w_option('CUTLINE_BLEND_DIST', float(self.options.blend_dist) / fx))
 
         src_bands = self.src_ds.RasterCount
         ld('src_bands', src_bands)
@@ -631,6 +1083,7 @@ class Pyramid(object):
             'blysize':          self.tile_size[1],
             'wo_ResampleAlg':   self.base_resampling,
             'wo_src_path':      cgi.escape(self.src_path, quote=True),
+            'wo_OpenOptions':   (warp_open_options % ovr_level) if overview else '',
             'warp_options':     '\n'.join(warp_options),
             'wo_src_srs':       gcp_proj if gcp_proj else src_proj,
             'wo_dst_srs':       self.proj_srs,
@@ -639,12 +1092,16 @@ class Pyramid(object):
             'wo_BandList':      '\n'.join(wo_BandList),
             'wo_DstAlphaBand':  warp_dst_alpha_band % (src_bands + 1) if src_bands < 4  and self.palette is None else '',
             'wo_Cutline':       (warp_cutline % cut_wkt) if cut_wkt else '',
+            'wo_MemoryLimit':   (warp_memory_limit % tiler_functions.mem_governor.warp_memory())
+                                    if tiler_functions.mem_governor else
+                                    warp_memory_limit_default,
             }
 
-        temp_vrt = os.path.join(self.dest, self.base + '.tmp.vrt') # auxilary VRT file
-        self.temp_files.append(temp_vrt)
-        with open(temp_vrt, 'w') as f:
-            f.write(vrt_text.encode('utf-8'))
+        if not self.options.in_memory: # keep a copy for debugging
+            temp_vrt = self.temp_path('.tmp.vrt') # auxilary VRT file
+            self.temp_files.append(temp_vrt)
+            with open(temp_vrt, 'w') as f:
+                f.write(vrt_text.encode('utf-8'))
 
         return gdal.Open(vrt_text, GA_ReadOnly)
 
@@ -674,9 +1131,11 @@ class Pyramid(object):
 
     #----------------------------
 
-    def generate_tiles(self):
+    def generate_tiles(self, part=None):
         'generate tiles'
     #----------------------------
+        if part:
+            self.set_part(part)
 
         # connect to src dataset
         try:
@@ -690,41 +1149,524 @@ class Pyramid(object):
 
         self.init_output()
 
-        # create a raster source for a base zoom
-        self.create_target_dataset()
-
         if not self.name:
             self.name = os.path.basename(self.dest)
 
-        ld('generate tiles')
+        if 'zooms' in self.part:
+            return self.join_zooms(self.part['zooms'])
 
-        self.progress()
+        if not self.part:
+            self.init_outputs()
 
-        top_results = filter(None, itertools.imap(self.make_tile_raster, self.get_top_tiles()))
-
-        self.progress(finished=True)
+        top_results = self.render_tiles()
 
         children, images, opacities = zip(*top_results)
-        # write top-level metadata (html/kml)
-        self.write_metadata(None, children)
-
         # cache back tiles transparency
         transparency = dict((
             (self.tile_path(tile), opc)
                 for tile, opc in itertools.chain(*opacities)
             ))
+
+        if 'subtree' in self.part or 'zoom' in self.part: # the metadata is written by a 'join' part
+            return self.dest, transparency, [opc_lst[0] for opc_lst in opacities]
+
+        # write top-level metadata (html/kml)
+        self.write_metadata(None, children)
+
+        if self.part: # the caller merges transparency of all the parts
+            return self.dest, transparency, []
+
+        self.write_inventory(transparency)
+        self.finish_outputs(children, list(itertools.chain(*opacities)))
+
+    #----------------------------
+
+    def render_tiles(self):
+        'render the tile tree(s) down from the top tiles'
+    #----------------------------
+        if 'join' in self.part: # take the lower level from the tiles rendered by the other parts
+            self.base_zoom, base_opacities = self.part['join']
+            self.base_img = PyramidImg(self, self.base_zoom, base_opacities)
+
+        governor = tiler_functions.mem_governor
+        if governor: # a join reads back the rendered tiles only, it is not weighed by the source
+            governor.acquire(self.src_weight() * self.part.get('fraction', 1))
+        try:
+            if 'zoom' in self.part: # warp a single zoom level from a source overview
+                self.base_zoom = self.part['zoom']
+                self.base_img = self.create_base_img(
+                    zoom=self.base_zoom, overview=self.select_overview(self.base_zoom))
+                del self.src_ds
+            elif not self.base_img: # create a raster source for a base zoom
+                self.create_target_dataset()
+
+            ld('generate tiles')
+
+            if self.options.prefetch:
+                tile_bytes = self.tile_size[0] * self.tile_size[1] * 4
+                self.prefetcher = Prefetcher(self.base_img, self.base_tiles(self.get_top_tiles()),
+                    self.tile_pixcorners, (self.options.prefetch << 20) // tile_bytes)
+
+            self.progress()
+
+            top_results = filter(None, itertools.imap(self.make_tile_raster, self.get_top_tiles()))
+            self.flush_metadata()
+
+            self.progress(finished=True)
+        finally:
+            if self.prefetcher:
+                self.prefetcher.close()
+                self.prefetcher = None
+            if governor:
+                governor.release()
+        return top_results
+
+    #----------------------------
+
+    def generate_mosaic(self, src_defs):
+        '''generate a single pyramid from a few sources;
+        each source is warped with its own cutline, the first sources are on top'''
+    #----------------------------
+        self.remove_dest()
+        os.makedirs(self.dest)
+        self.new_dest = False
+        self.mosaic = []
+
+        for i, (src, delete_src, src_xml) in enumerate(src_defs):
+            self.src = src
+            self.options.delete_src = delete_src
+            self.options.src_xml = src_xml
+            self.temp_suffix = '.%d' % i
+            try:
+                self.open_source_dataset()
+            except RuntimeError as exc:
+                if self.options.skip_invalid:
+                    logging.error(exc.message)
+                    continue
+                else:
+                    raise
+            corners = self.auto_warp_corners()
+            self.mosaic.append(LooseDict(
+                src_ds=     self.src_ds,
+                src_path=   self.src_path,
+                src_dir=    self.src_dir,
+                base=       self.base,
+                corners=    corners,
+                max_zoom=   max(self.res2zoom_xy(self.auto_warp_res(corners))),
+                weight=     self.src_weight(),
+                ))
+        assert self.mosaic, 'No valid sources for a mosaic'
+
+        logging.info(' %s -> %s ' % (', '.join((layer.base for layer in self.mosaic)), self.dest))
+
+        # the mosaic covers all the sources
+        xx, yy = zip(*flatten((layer.corners for layer in self.mosaic)))
+        target_corners = ((min(xx), max(yy)), (max(xx), min(yy)))
+        self.tiles_prefix = self.options.tiles_prefix
+        self.raster_corners = self.clip_corners(target_corners)
+        self.calc_zoom(target_corners, max((layer.max_zoom for layer in self.mosaic)))
+
+        # warp each source over its own footprint only
+        base_lst = []
+        for layer in self.mosaic:
+            self.src_ds = layer.src_ds
+            self.src_path = layer.src_path
+            self.src_dir = layer.src_dir
+            self.base = layer.base
+            base_lst.append(self.create_base_img(self.clip_corners(layer.corners)))
+            layer.src_ds = None
+        del self.src_ds
+
+        self.base_img = MosaicImg(base_lst)
+        self.base = os.path.splitext(os.path.basename(self.dest))[0]
+        if not self.name:
+            self.name = os.path.basename(self.dest)
+        self.init_outputs()
+
+        top_results = self.render_tiles()
+
+        children, images, opacities = zip(*top_results)
+        self.write_metadata(None, children)
+        self.write_inventory(dict((
+            (self.tile_path(tile), opc)
+                for tile, opc in itertools.chain(*opacities)
+            )))
+        self.finish_outputs(children, list(itertools.chain(*opacities)))
+
+    #----------------------------
+
+    def rebuild_overviews(self):
+        '''regenerate the overview levels of an existing pyramid from its base zoom tiles,
+        the source is not opened'''
+    #----------------------------
+        self.new_dest = False
+        self.base = os.path.basename(self.dest)
+        self.tiles_prefix = self.options.tiles_prefix
+        self.resampling = resampling_map[self.options.overview_resampling]
+
+        tilemap = read_tilemap(self.dest)
+        self.tile_ext = '.' + tilemap['tiles']['ext']
+        self.options.tile_format = tilemap['tiles']['ext'].lower()
+        if not self.name:
+            self.name = tilemap['properties']['title'] or os.path.basename(self.dest)
+        self.description = tilemap['properties']['description'] or ''
+
+        # opacities of the existing tiles
+        inventory = TileInventory(self.dest, self.path_template, self.tile_ext)
+        transparency = read_transparency(self.dest)
+        if not inventory.zooms:
+            inventory.update(transparency)
+        zoom_levels = inventory.zoom_levels()
+        if not zoom_levels:
+            raise RuntimeError('No tiles to build overviews from: %s' % self.dest)
+        base_zoom = zoom_levels[-1]
+        base_tiles = dict(((self.path_tile(tile), inventory.get(tile, -1))
+            for tile in inventory.tiles(base_zoom)))
+
+        # the tiles on both sides of 180 meridian are kept together
+        n_x = self.n_tiles_xy(base_zoom)[0]
+        xx = sorted(set((x for z, x, y in base_tiles)))
+        gaps = [(xx[i + 1] - xx[i], xx[i]) for i in range(len(xx) - 1)]
+        if gaps and max(gaps)[0] > n_x - xx[-1] + xx[0]:
+            split_x = max(gaps)[1]
+            base_tiles = dict((((z, x + n_x if x <= split_x else x, y), opc)
+                for (z, x, y), opc in base_tiles.items()))
+
+        z, xx, yy = zip(*base_tiles)
+        tsx, tsy = self.tile_size
+        self.raster_corners = (
+            self.pix2coord(base_zoom, (min(xx) * tsx, min(yy) * tsy)),
+            self.pix2coord(base_zoom, ((max(xx) + 1) * tsx - 1, (max(yy) + 1) * tsy - 1)),
+            )
+        self.set_zoom_range(self.options.zoom, (zoom_levels[0], base_zoom))
+        self.zoom_range = [base_zoom] + [zoom for zoom in self.zoom_range if zoom < base_zoom]
+        self.base_zoom = self.max_zoom = base_zoom
+
+        logging.info(' %s: zoom %d -> %s ' % (self.dest, base_zoom, self.zoom_range[1:]))
+
+        # tiles' palette
+        tile_img = Image.open(os.path.join(self.dest, self.tile_path(next(iter(base_tiles)))))
+        if tile_img.mode == 'P':
+            self.palette = tile_img.getpalette()
+            if isinstance(tile_img.info.get('transparency'), int):
+                self.transparency = tile_img.info['transparency']
+
+        # drop the old overviews
+        for zoom in zoom_levels[:-1]:
+            for path in inventory.paths(zoom):
+                remove_file(os.path.join(self.dest, path))
+                transparency.pop(path, None)
+            inventory.remove_zoom(zoom)
+        inventory.flush()
+
+        self.base_img = PyramidImg(self, base_zoom, base_tiles.items())
+        top_results = self.render_tiles()
+
+        children, images, opacities = zip(*top_results)
+        self.write_metadata(None, children)
+        transparency.update(((self.tile_path(tile), opc)
+            for tile, opc in itertools.chain(*opacities)))
+        self.write_inventory(transparency)
+
+    #----------------------------
+
+    def write_inventory(self, transparency):
+        'save opacities of the tiles into transparency.json and the tile inventory'
+    #----------------------------
         write_transparency(self.dest, transparency)
+        inventory = TileInventory(self.dest, self.path_template, self.tile_ext)
+        inventory.update(transparency)
+        inventory.flush()
+
+    #----------------------------
+
+    def join_zooms(self, transparency):
+        'tile-level and top-level metadata of a pyramid rendered by zoom parts'
+    #----------------------------
+        del self.src_ds
+
+        def exists(tile):
+            return self.tile_path(tile) in transparency
+
+        for i, zoom in enumerate(self.zoom_range):
+            ch_zoom = self.zoom_range[i - 1] if i > 0 else None
+            for tile in self.zoom_tiles(zoom):
+                if not exists(tile):
+                    continue
+                children = []
+                if ch_zoom is not None:
+                    z, x, y = tile
+                    n = 2 ** (ch_zoom - zoom)
+                    children = [ch for ch in ((ch_zoom, x * n + dx, y * n + dy)
+                        for dx in range(n) for dy in range(n)) if exists(ch)]
+                self.write_metadata(tile, children)
+        self.flush_metadata()
+
+        top_tiles = filter(exists, self.zoom_tiles(self.zoom_range[-1]))
+        self.write_metadata(None, top_tiles)
+        self.write_inventory(transparency)
+
+    #----------------------------
+
+    def estimate_zooms(self):
+        '''build the source overviews if missing;
+        returns the zoom levels to render on their own with their tile counts'''
+    #----------------------------
+        self.new_dest = False
+        self.temp_dir = tempfile.gettempdir()
+        self.temp_suffix = '.%d' % os.getpid()
+        try:
+            self.open_source_dataset()
+        except RuntimeError as exc:
+            if self.options.skip_invalid:
+                logging.error(exc.message)
+                return None
+            else:
+                raise
+        self.build_overviews()
+        self.init_output()
+        return {
+            'dest': self.dest,
+            'zooms': dict(((zoom, len(list(self.zoom_tiles(zoom)))) for zoom in self.zoom_range)),
+            }
+
+    #----------------------------
+
+    def set_part(self, part):
+        '''render just a part of the pyramid:
+        {'subtree': [tile, ...]} -- subtrees below a list of tiles,
+        {'join': (zoom, [(tile, opacity), ...])} -- top levels over the tiles rendered by subtree parts,
+        {'zoom': zoom} -- a zoom level warped from a source overview,
+        {'zooms': {path: opacity, ...}} -- metadata of the zoom levels rendered by zoom parts'''
+    #----------------------------
+        self.part = part
+        self.new_dest = False # the caller takes care of the destination
+        self.temp_suffix = '.%s' % part['id']
+
+    #----------------------------
+
+    def estimate_cost(self, n_parts=1):
+        'estimate rendering cost, split the tile tree into subtrees'
+    #----------------------------
+        self.new_dest = False
+        self.temp_dir = tempfile.gettempdir()
+        self.temp_suffix = '.%d' % os.getpid()
+        try:
+            self.open_source_dataset()
+        except RuntimeError as exc:
+            if self.options.skip_invalid:
+                logging.error(exc.message)
+                return None
+            else:
+                raise
+        self.init_output()
+
+        split_zoom, subtrees = self.split_tiles(n_parts)
+        return {
+            'dest':         self.dest,
+            'cost':         self.src_ds.RasterXSize * self.src_ds.RasterYSize * len(self.zoom_range),
+            'split_zoom':   split_zoom,
+            'subtrees':     subtrees,
+            }
+
+    #----------------------------
+
+    def plan(self, n_samples=16):
+        '''estimate number of tiles, disk space and rendering time per zoom
+        by rendering a random sample of the base zoom tiles'''
+    #----------------------------
+        self.new_dest = False
+        self.temp_dir = tempfile.gettempdir()
+        self.temp_suffix = '.%d' % os.getpid()
+        try:
+            self.open_source_dataset()
+        except RuntimeError as exc:
+            if self.options.skip_invalid:
+                logging.error(exc.message)
+                return None
+            else:
+                raise
+        self.init_output()
+
+        footprint = self.footprint()
+        zoom_rows = dict(((zoom, self.footprint_rows(zoom, footprint)) for zoom in self.zoom_range))
+
+        # render sample tiles of the base zoom
+        self.create_target_dataset()
+        base_rows = zoom_rows[self.max_zoom]
+        row_lst = sorted(base_rows.items())
+        n_base = sum((x1 - x0 + 1 for y, (x0, x1) in row_lst))
+        warp_times, encode_times, resize_times, sizes = [], [], [], []
+        for k in sorted(random.sample(xrange(n_base), min(n_samples, n_base))):
+            for y, (x0, x1) in row_lst: # k-th tile of the rows
+                if k <= x1 - x0:
+                    break
+                k -= x1 - x0 + 1
+            tile = (self.max_zoom, x0 + k, y)
+
+            start = time.time()
+            tile_img, opacity = self.base_img.get_tile(self.tile_pixcorners(tile))
+            warp_times.append(time.time() - start)
+            if tile_img is None: # transparent tiles are not written
+                continue
+
+            start = time.time()
+            f = StringIO.StringIO()
+            self.save_tile(tile_img, f)
+            encode_times.append(time.time() - start)
+            sizes.append(len(f.getvalue()))
+
+            mosaic = tile_img.resize([i * 2 for i in self.tile_size]) # as of an upper zoom tile
+            start = time.time()
+            mosaic.resize(self.tile_size, self.resampling)
+            resize_times.append(time.time() - start)
+
+        def mean(lst):
+            return float(sum(lst)) / len(lst) if lst else 0.
+        written = float(len(sizes)) / len(warp_times) if warp_times else 0.
+        tile_size = mean(sizes)
+        block = 4096 # file system block
+        tile_disk = -(-int(tile_size) // block) * block
+
+        zooms = {}
+        for zoom, rows in zoom_rows.items():
+            n_tiles = sum((x1 - x0 + 1 for y, (x0, x1) in rows.items()))
+            n_written = int(round(n_tiles * written))
+            if zoom == self.max_zoom:
+                seconds = n_tiles * mean(warp_times) + n_written * mean(encode_times)
+            else:
+                seconds = n_written * (mean(encode_times) + mean(resize_times))
+            zooms[zoom] = {
+                'tiles':    n_written,
+                'bytes':    int(n_written * tile_size),
+                'disk':     n_written * tile_disk,
+                'seconds':  round(seconds, 3),
+                }
+        total = dict(((key, sum((z[key] for z in zooms.values()))) for key in ('tiles', 'bytes', 'disk', 'seconds')))
+        total['wall_seconds'] = round(total['seconds'] / cpu_count(), 3)
+
+        return {
+            'src':      self.src,
+            'dest':     self.dest,
+            'zooms':    zooms,
+            'total':    total,
+            'sample': {
+                'tiles':            len(warp_times),
+                'transparent':      len(warp_times) - len(sizes),
+                'warp_seconds':     round(mean(warp_times), 5),
+                'encode_seconds':   round(mean(encode_times), 5),
+                'resize_seconds':   round(mean(resize_times), 5),
+                'tile_bytes':       int(tile_size),
+                },
+            }
+
+    #----------------------------
+
+    def footprint(self):
+        'source footprint polygons at the target SRS: the cutline or the raster border'
+    #----------------------------
+        rings = []
+        cut_wkt = self.get_cutline() if self.options.cut or self.options.cutline else None
+        if cut_wkt:
+            geom = ogr.CreateGeometryFromWkt(cut_wkt)
+            for i in range(geom.GetGeometryCount()):
+                rings.append([p[:2] for p in geom.GetGeometryRef(i).GetGeometryRef(0).GetPoints()])
+        else:
+            width = self.src_ds.RasterXSize
+            height = self.src_ds.RasterYSize
+            n = 25 # points per side
+            rings.append(
+                [(width * i / n, 0) for i in range(n)] +
+                [(width, height * i / n) for i in range(n)] +
+                [(width * (n - i) / n, height) for i in range(n)] +
+                [(0, height * (n - i) / n) for i in range(n)])
+
+        transformer = GdalTransformer(self.src_ds, DST_SRS=self.proj_srs)
+        footprint = []
+        for ring in rings:
+            try:
+                footprint.append(transformer.transform(ring))
+            except (AssertionError, RuntimeError): # fall back to the raster box
+                footprint.append([self.raster_corners[0],
+                    (self.raster_corners[1][0], self.raster_corners[0][1]),
+                    self.raster_corners[1],
+                    (self.raster_corners[0][0], self.raster_corners[1][1])])
+        return footprint
+
+    #----------------------------
+
+    def footprint_rows(self, zoom, footprint):
+        '''tiles intersecting the footprint: {tile row: (first tile, last tile)};
+        the polygon edges are clipped by each row strip, the row spans the clipped edges'''
+    #----------------------------
+        tile_w, tile_h = self.tile_size
+        rows = {}
+        for ring in footprint:
+            pix = [self.coord2pix(zoom, p) for p in ring]
+            for (x0, y0), (x1, y1) in zip(pix, pix[1:] + pix[:1]):
+                for ty in range(int(min(y0, y1) // tile_h), int(max(y0, y1) // tile_h) + 1):
+                    if y0 == y1:
+                        xs = (x0, x1)
+                    else: # the part of the edge inside the row strip
+                        ta, tb = [min(1., max(0., (y - y0) / float(y1 - y0))) for y in (ty * tile_h, (ty + 1) * tile_h)]
+                        xs = (x0 + (x1 - x0) * ta, x0 + (x1 - x0) * tb)
+                    tx0, tx1 = int(min(xs) // tile_w), int(max(xs) // tile_w)
+                    if ty in rows:
+                        tx0, tx1 = min(tx0, rows[ty][0]), max(tx1, rows[ty][1])
+                    rows[ty] = (tx0, tx1)
+
+        # clip to the tiles covering the target raster
+        tile_tl, tile_br = self.corner_tiles(zoom)
+        xx = (tile_tl[1], tile_br[1])
+        yy = (tile_tl[2], tile_br[2])
+        clipped = {}
+        for ty, (tx0, tx1) in rows.items():
+            tx0, tx1 = max(tx0, min(xx)), min(tx1, max(xx))
+            if min(yy) <= ty <= max(yy) and tx0 <= tx1:
+                clipped[ty] = (tx0, tx1)
+        return clipped
+
+    #----------------------------
+
+    def split_tiles(self, n_parts):
+        'split tiles at the highest zoom level which has at least n_parts tiles'
+    #----------------------------
+        for zoom in reversed(self.zoom_range):
+            tiles = morton_order(self.zoom_tiles(zoom)) # compact parts
+            if len(tiles) >= n_parts:
+                break
+        chunk = -(-len(tiles) // n_parts)
+        return zoom, [tiles[i: i + chunk] for i in range(0, len(tiles), chunk)]
+
+    def src_weight(self):
+        'memory the source would take when fully cached'
+    #----------------------------
+        if self.mosaic:
+            return sum((layer.weight for layer in self.mosaic))
+        if self.base_img and self.base_img.tiles_exist: # tiles are read one by one
+            return 0
+        return self.src_ds.RasterXSize * self.src_ds.RasterYSize * self.src_ds.RasterCount
 
     #----------------------------
 
     def get_top_tiles(self):
 
     #----------------------------
-        min_zoom = self.zoom_range[-1]
-        tile_tl, tile_br = self.corner_tiles(min_zoom)
+        if 'subtree' in self.part:
+            return (tuple(tile) for tile in self.part['subtree'])
+        if 'zoom' in self.part:
+            return morton_order(self.zoom_tiles(self.part['zoom']))
+        return morton_order(self.zoom_tiles(self.zoom_range[-1]))
+
+    #----------------------------
+
+    def zoom_tiles(self, zoom):
+        'tiles covering the raster at a zoom level'
+    #----------------------------
+        tile_tl, tile_br = self.corner_tiles(zoom)
         xx = (tile_tl[1], tile_br[1])
         yy = (tile_tl[2], tile_br[2])
-        return ((min_zoom, x, y) for y in range(min(yy), max(yy)+1) for x in range(min(xx), max(xx)+1))
+        return ((zoom, x, y) for y in range(min(yy), max(yy)+1) for x in range(min(xx), max(xx)+1))
 
     #----------------------------
 
@@ -732,15 +1674,21 @@ class Pyramid(object):
 
     #----------------------------
 
-        if not self.in_range(tile, check_zoom=False):
+        if not self.in_range(tile, check_zoom=False) or not self.base_img.covers(tile):
             return
 
         zoom, x, y = tile
-        if zoom == self.max_zoom: # get from the base image
-            tile_img, opacity = self.base_img.get_tile(self.tile_pixcorners(tile))
+        if zoom == self.base_zoom: # get from the base image
+            if self.prefetcher:
+                tile_img, opacity = self.prefetcher.get_tile(tile)
+            else:
+                tile_img, opacity = self.base_img.get_tile(self.tile_pixcorners(tile))
             opacity_lst = [(tile, opacity)]
+            composite = None
+            if self.base_img.tiles_exist: # already in the pyramid
+                return (tile, tile_img, opacity_lst) if tile_img is not None else None
         else: # merge children
-            tile_img, opacity_lst = self.assemble_tile(tile)
+            tile_img, opacity_lst, composite = self.assemble_tile(tile)
 
         #~ ld('make_tile_raster', tile, tile_img, opacity)
         if tile_img is not None and self.zoom_in_range(zoom):
@@ -750,30 +1698,58 @@ class Pyramid(object):
             self.write_tile(tile, tile_img)
 
             # write tile-level metadata (html/kml)
-            children = [ch for ch, opacity in opacity_lst[1:]]
-            self.write_metadata(tile, children)
+            if 'zoom' not in self.part: # children are not known yet
+                children = [ch for ch, opacity in opacity_lst[1:]]
+                self.write_metadata(tile, children)
+
+                if self.outputs:
+                    self.write_outputs(tile, tile_img, composite, children)
 
             return tile, tile_img, opacity_lst
 
     #----------------------------
 
+    def child_tiles(self, tile):
+        'tiles at the next zoom level of the range, in the order they are rendered'
+    #----------------------------
+        zoom, x, y = tile
+        ch_zoom = self.zoom_range[self.zoom_range.index(zoom) - 1] # children's zoom
+        len_xy = int(2 ** (ch_zoom - zoom))
+        return morton_order(((ch_zoom, x * len_xy + i, y * len_xy + j) for i in range(len_xy) for j in range(len_xy)))
+
+    #----------------------------
+
+    def base_tiles(self, tiles):
+        'base zoom tiles under a list of tiles, in the order they are rendered'
+    #----------------------------
+        for tile in tiles:
+            if not self.in_range(tile, check_zoom=False) or not self.base_img.covers(tile):
+                continue
+            if tile[0] == self.base_zoom:
+                yield tile
+            else:
+                for base_tile in self.base_tiles(self.child_tiles(tile)):
+                    yield base_tile
+
+    #----------------------------
+
     def assemble_tile(self, tile):
 
     #----------------------------
 
         zoom, x, y = tile
-        ch_zoom = self.zoom_range[self.zoom_range.index(zoom) - 1] # children's zoom
+        children = self.child_tiles(tile)
+        ch_zoom = children[0][0]
 
         # map children locations inside the parent raster
         len_xy = int(2 ** (ch_zoom - zoom))
         children_map = dict(
-            (((ch_zoom, x * len_xy + i, y * len_xy + j), # child tile
-                (self.tile_size[0] * i, self.tile_size[1] * j)) # offset inside the parent tile
-            for i in range(len_xy) for j in range(len_xy))
+            ((ch, (self.tile_size[0] * (ch[1] - x * len_xy), self.tile_size[1] * (ch[2] - y * len_xy)))
+                for ch in children) # offset inside the parent tile
             )
         #ld(tile, ch_mozaic)
 
-        ch_results = filter(None, itertools.imap(self.make_tile_raster, children_map.keys()))
+        ch_results = filter(None, itertools.imap(self.make_tile_raster, children))
         #~ ld('tile', tile, 'children', children, 'ch_results', ch_results)
 
         opacity = 0
@@ -812,12 +1788,23 @@ class Pyramid(object):
 
         opacity_lst.insert(0, (tile, opacity))
 
-        return None if not tile_img else tile_img.resize(self.tile_size, self.resampling), opacity_lst
+        if not tile_img:
+            return None, opacity_lst, None
+        return tile_img.resize(self.tile_size, self.resampling), opacity_lst, tile_img
 
     #----------------------------
 
     def write_tile(self, tile, tile_img):
 
+    #----------------------------
+        self.save_tile(tile_img, self.tile_file(tile))
+
+        self.progress()
+
+    #----------------------------
+
+    def tile_file(self, tile):
+        'full path to a tile, the directory is created'
     #----------------------------
         rel_path = self.tile_path(tile)
         full_path = os.path.join(self.dest, rel_path)
@@ -825,7 +1812,82 @@ class Pyramid(object):
             os.makedirs(os.path.dirname(full_path))
         except:
             pass
+        return full_path
+
+    #----------------------------
+
+    def init_outputs(self):
+        '''extra pyramids written from the same base tiles (--output PROFILE:FORMAT[:SCALE]):
+        another tile layout, tile format and tile size'''
+    #----------------------------
+        self.outputs = []
+        for spec in self.options.output or []:
+            parms = spec.split(':')
+            if len(parms) not in (2, 3):
+                raise Exception('Invalid output: %s' % spec)
+            profile = self.profile_class(parms[0])
+            scale = int(parms[2]) if len(parms) > 2 else 1
+
+            opt = LooseDict(self.options)
+            opt.output = None
+            opt.tile_format = parms[1].lower()
+            opt.tile_ext = '.' + opt.tile_format
+            ext = '%s-%s%s' % (profile.defaul_ext, opt.tile_format, '@%dx' % scale if scale > 1 else '')
+            out = profile(self.src, dest_path(self.src, opt.dest_dir, ext), opt)
+            if (txt2proj4(out.srs) != txt2proj4(self.srs) or list(out.zoom0_tiles) != list(self.zoom0_tiles)
+                    or list(out.tile_size) != list(self.tile_size)):
+                raise Exception('Output %s does not share the tile grid of %s' % (spec, self.profile))
+
+            # the same tile grid, a tile is 'scale' times larger in pixels
+            for attr in ('proj_srs', 'geog_srs', 'proj2geog', 'max_raster_origin', 'raster_corners',
+                    'max_zoom', 'base_zoom', 'tiles_prefix', 'name', 'description',
+                    'palette', 'transparency', 'resampling', 'base'):
+                setattr(out, attr, getattr(self, attr))
+            out.scale = scale
+            out.tile_size = tuple((i * scale for i in self.tile_size))
+            out.min_res = [r / scale for r in self.min_res]
+            out.zoom_range = [zoom for zoom in self.zoom_range
+                if scale == 1 or zoom < self.base_zoom] # larger tiles are made of the upper zoom tiles
+
+            out.remove_dest()
+            os.makedirs(out.dest)
+            logging.info(' %s -> %s ' % (self.src, out.dest))
+            self.outputs.append(out)
+
+    #----------------------------
+
+    def write_outputs(self, tile, tile_img, composite, children):
+        'encode a tile for the extra outputs'
+    #----------------------------
+        if composite is not None and self.palette:
+            composite.putpalette(self.palette)
+        for out in self.outputs:
+            if not out.zoom_in_range(tile[0]):
+                continue
+            if out.scale == 1:
+                out_img = tile_img
+            elif composite.size == out.tile_size:
+                out_img = composite
+            else:
+                out_img = composite.resize(out.tile_size, self.resampling)
+            out.save_tile(out_img, out.tile_file(tile))
+            out.write_metadata(tile, [ch for ch in children if out.zoom_in_range(ch[0])])
+
+    #----------------------------
+
+    def finish_outputs(self, children, opacities):
+        'top-level metadata and inventories of the extra outputs'
+    #----------------------------
+        for out in self.outputs:
+            out.write_metadata(None, [tile for tile in children if out.zoom_in_range(tile[0])])
+            out.write_inventory(dict(((out.tile_path(tile), opc)
+                for tile, opc in opacities if out.zoom_in_range(tile[0]))))
 
+    #----------------------------
+
+    def save_tile(self, tile_img, dst):
+        'encode a tile into a file or a file object'
+    #----------------------------
         tile_format = self.options.tile_format
         if self.options.paletted and tile_format == 'png':
             try:
@@ -841,12 +1903,12 @@ class Pyramid(object):
                 #ld('tile_img.mode', tile_img.mode)
                 pass
 
+        Image.init()
+        pil_format = Image.EXTENSION.get(self.tile_ext.lower())
         if self.transparency is not None:
-            tile_img.save(full_path, transparency=self.transparency)
+            tile_img.save(dst, pil_format, transparency=self.transparency)
         else:
-            tile_img.save(full_path)
-
-        self.progress()
+            tile_img.save(dst, pil_format)
 
     #----------------------------
 
@@ -858,6 +1920,13 @@ class Pyramid(object):
 
     #----------------------------
 
+    def flush_metadata(self):
+        'tile-level metadata is complete'
+    #----------------------------
+        pass
+
+    #----------------------------
+
     def write_tilemap(self):
         '''Generate JSON for a tileset description'''
     #----------------------------
@@ -910,18 +1979,17 @@ class Pyramid(object):
 
     @staticmethod
     def profile_class(profile_name):
-        for cls in profile_map:
-            if cls.profile == profile_name:
-                return cls
+        for cls in profile_map.lookup(profile_name):
+            return cls
         else:
             raise Exception("Invalid profile: %s" % profile_name)
 
     @staticmethod
     def profile_lst(tty=False):
         if not tty:
-            return [c.profile for c in profile_map]
+            return profile_map.keys()
         print('\nOutput profiles and compatibility:\n')
-        [print('%10s - %s' % (c.profile, c.__doc__)) for c in profile_map]
+        [print('%10s - %s' % (c.profile, c.__doc__)) for c in profile_map.load_all()]
         print()
 
     def get_corner_coords(self, corner):
@@ -996,11 +2064,13 @@ class Pyramid(object):
             (br[0] if br[0] > -180 else br[0] + 360, br[1]),
             ] for tl, br in zip(tl_lst, br_lst)]
 
-    def corner_tiles(self, zoom):
-        p_tl = self.coord2pix(zoom, self.raster_corners[0])
+    def corner_tiles(self, zoom, corners=None):
+        if corners is None:
+            corners = self.raster_corners
+        p_tl = self.coord2pix(zoom, corners[0])
         t_tl = self.pix2tile(zoom, (p_tl[0], p_tl[1]))
 
-        p_br = self.coord2pix(zoom, self.raster_corners[1])
+        p_br = self.coord2pix(zoom, corners[1])
         t_br = self.pix2tile(zoom, (p_br[0], p_br[1]))
 
         box_tl, box_br = [self.tile_corners(t) for t in (t_tl, t_br)]
@@ -1038,6 +2108,7 @@ class Pyramid(object):
 
         self.zoom_range = list(reversed(sorted(set(zlist))))
         self.max_zoom = self.zoom_range[0]
+        self.base_zoom = self.max_zoom
         ld('zoom_range', self.zoom_range, default_range)
 
     def zoom_in_range(self, zoom):
@@ -1100,6 +2171,8 @@ class Pyramid(object):
             pf('')
         elif self.count % self.tick_rate == 0:
             pf('.', end='')
+        if tiler_functions.mem_governor and self.count % self.tick_rate == 0:
+            tiler_functions.mem_governor.adjust()
         self.count += 1
 
 # Pyramid
@@ -1214,11 +2287,11 @@ warp_vrt = '''<VRTDataset rasterXSize="%(xsize)d" rasterYSize="%(ysize)d" subCla
   <BlockXSize>%(blxsize)d</BlockXSize>
   <BlockYSize>%(blysize)d</BlockYSize>
   <GDALWarpOptions>
-    <!-- <WarpMemoryLimit>6.71089e+07</WarpMemoryLimit> -->
+%(wo_MemoryLimit)s
     <ResampleAlg>%(wo_ResampleAlg)s</ResampleAlg>
     <WorkingDataType>Byte</WorkingDataType>
     <SourceDataset relativeToVRT="0">%(wo_src_path)s</SourceDataset>
-%(warp_options)s
+%(wo_OpenOptions)s%(warp_options)s
     <Transformer>
       <ApproxTransformer>
         <MaxError>0.125</MaxError>
@@ -1246,6 +2319,9 @@ warp_band = '  <VRTRasterBand dataType="Byte" band="%d" subClass="VRTWarpedRaste
 warp_band_color = '>\n    <ColorInterp>%s</ColorInterp>\n  </VRTRasterBand'
 warp_dst_alpha_band = '    <DstAlphaBand>%d</DstAlphaBand>\n'
 warp_cutline = '    <Cutline>%s</Cutline>\n'
+warp_open_options = '    <OpenOptions>\n      <OOI key="OVERVIEW_LEVEL">%d</OOI>\n    </OpenOptions>\n'
+warp_memory_limit = '    <WarpMemoryLimit>%d</WarpMemoryLimit>'
+warp_memory_limit_default = '    <!-- <WarpMemoryLimit>6.71089e+07</WarpMemoryLimit> -->'
 warp_dst_geotr = '            <DstGeoTransform> %r, %r, %r, %r, %r, %r</DstGeoTransform>'
 warp_dst_igeotr = '            <DstInvGeoTransform> %r, %r, %r, %r, %r, %r</DstInvGeoTransform>'
 warp_src_geotr = '            <SrcGeoTransform> %r, %r, %r, %r, %r, %r</SrcGeoTransform>'
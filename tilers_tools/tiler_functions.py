@@ -40,6 +40,7 @@ import locale
 import csv
 import htmlentitydefs
 import json
+import threading
 
 try:
     from osgeo import gdal
@@ -89,21 +90,29 @@ def set_nothreads():
     global multiprocessing
     multiprocessing = None
 
-def parallel_map(func, iterable):
+def parallel_map(func, iterable, initializer=None, initargs=(), chunksize=None):
     ld('parallel_map', multiprocessing)
     #~ return map(func, iterable)
 
     if multiprocessing is None or len(iterable) < 2:
+        if initializer:
+            initializer(*initargs)
         return map(func, iterable)
     else:
         # map in parallel
-        mp_pool = multiprocessing.Pool() # multiprocessing pool
-        res = mp_pool.map(func, iterable)
+        mp_pool = multiprocessing.Pool(initializer=initializer, initargs=initargs) # multiprocessing pool
+        res = mp_pool.map(func, iterable, chunksize)
         # wait for threads to finish
         mp_pool.close()
         mp_pool.join()
     return res
 
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except (AttributeError, NotImplementedError):
+        return 1
+
 def flatten(two_level_list):
     return list(itertools.chain(*two_level_list))
 
@@ -134,6 +143,65 @@ def strip_html(text):
 
     return re.sub('(?s)<[^>]*>|&#?\w+;', replace, text)
 
+# a byte of x (or y) with its bits spread to the even bits of a 16-bit word, and back
+morton_spread = [sum(((b >> i) & 1) << (2 * i) for i in range(8)) for b in range(256)]
+morton_even = [sum(((b >> (2 * i)) & 1) << i for i in range(4)) for b in range(256)]
+
+def morton_key(x, y):
+    'position of (x, y) along the Z-order (Morton) curve: bits of x and y interleaved'
+    key = 0
+    shift = 0
+    while x | y:
+        key |= (morton_spread[x & 0xFF] | morton_spread[y & 0xFF] << 1) << shift
+        x >>= 8
+        y >>= 8
+        shift += 16
+    return key
+
+def morton_decode(key):
+    '(x, y) of a Morton key'
+    x = y = 0
+    shift = 0
+    while key:
+        byte = key & 0xFF
+        x |= morton_even[byte] << shift
+        y |= morton_even[byte >> 1] << shift
+        key >>= 8
+        shift += 4
+    return x, y
+
+def morton_ranges(xmin, ymin, xmax, ymax):
+    '''Morton keys of the (x, y) of a box as a list of (first, last) ranges in the key order:
+    the box is split into aligned squares, each square is a range of keys'''
+    ranges = []
+    def split(x0, y0, size):
+        x1, y1 = x0 + size - 1, y0 + size - 1
+        if x0 > xmax or x1 < xmin or y0 > ymax or y1 < ymin:
+            return
+        if xmin <= x0 and x1 <= xmax and ymin <= y0 and y1 <= ymax:
+            first = morton_key(x0, y0)
+            last = first + size * size - 1
+            if ranges and ranges[-1][1] + 1 == first: # adjacent along the curve
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+            return
+        half = size // 2
+        for dy in (0, half):
+            for dx in (0, half):
+                split(x0 + dx, y0 + dy, half)
+
+    if xmin <= xmax and ymin <= ymax:
+        size = 1
+        while size <= max(xmax, ymax):
+            size <<= 1
+        split(0, 0, size)
+    return ranges
+
+def morton_order(tiles):
+    'sort (z, x, y) tiles along the Z-order curve, so neighbours are visited together'
+    return sorted(tiles, key=lambda tile: morton_key(tile[1], tile[2]))
+
 def if_set(x, default=None):
     return x if x is not None else default
 
@@ -175,6 +243,30 @@ def command(params, child_in=None):
     ld('<', child_out, child_err)
     return child_out
 
+def write_file(path, data):
+    'write a file, /vsimem/ paths are kept in the GDAL memory file system'
+    if path.startswith('/vsimem/'):
+        gdal.FileFromMemBuffer(path, data)
+    else:
+        with open(path, 'w') as f:
+            f.write(data)
+
+def remove_file(path):
+    if path.startswith('/vsimem/'):
+        gdal.Unlink(path)
+    else:
+        os.remove(path)
+
+def replace_file(src, dst):
+    'rename a file over another one, on Windows the destination is removed first'
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
 def dest_path(src, dest_dir, ext='', template='%s'):
     src_dir, src_file = os.path.split(src)
     base, sext = os.path.splitext(src_file)
@@ -216,6 +308,138 @@ class LooseDict(object):
     def update(self, other_dict):
         self.__dict__.update(other_dict)
 
+class PluginRegistry(list):
+    '''plugin classes identified by a key attribute;
+    a plugin module is imported only when one of its keys is looked up'''
+
+    def __init__(self, key):
+        list.__init__(self)
+        self.key = key
+        self.lazy = [] # (key, module) of plugins not imported yet
+
+    def register(self, module, *keys):
+        'declare plugins without importing their module'
+        self.lazy.extend(((key, module) for key in keys))
+
+    def load(self, module):
+        'import a plugin module, its classes append themselves to the registry'
+        self.lazy = [(k, m) for k, m in self.lazy if m != module]
+        __import__(module)
+
+    def select(self, match):
+        'plugin classes with the keys accepted by a match function'
+        for key, module in self.lazy[:]:
+            if match(key):
+                self.load(module)
+        return [cls for cls in self if match(getattr(cls, self.key))]
+
+    def lookup(self, key):
+        return self.select(lambda k: k == key)
+
+    def keys(self):
+        return [getattr(cls, self.key) for cls in self] + [k for k, m in self.lazy]
+
+    def load_all(self):
+        for key, module in self.lazy[:]:
+            self.load(module)
+        return self
+
+#############################
+#
+# memory budget shared by worker processes
+#
+#############################
+
+def process_rss():
+    'resident set size of the current process, None if unknown'
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+class MemoryGovernor(object):
+    '''Shares a memory budget between GDAL caches of pool workers'''
+
+    cache_part = 0.75       # part of a job's share given to GDAL_CACHEMAX, the rest goes to the warper
+    min_share = 16 << 20    # don't starve a job below this
+
+    def __init__(self, budget_mb):
+        self.budget = int(budget_mb) << 20
+        if multiprocessing:
+            self.cond = multiprocessing.Condition()
+            self.reserved = multiprocessing.Value('d', 0, lock=False) # sum of active jobs' weights
+            self.pending = multiprocessing.Value('d', 0, lock=False)  # weight of a big job waiting for memory
+            self.pending_ticket = multiprocessing.Value('l', 0, lock=False) # and its ticket
+            self.tickets = multiprocessing.Value('l', 0, lock=False)
+        else:
+            self.cond = threading.Condition()
+            self.reserved = LooseDict(value=0.)
+            self.pending = LooseDict(value=0.)
+            self.pending_ticket = LooseDict(value=0)
+            self.tickets = LooseDict(value=0)
+        self.weight = 0
+
+    def acquire(self, weight):
+        'reserve a part of the budget for a job, wait while it is taken by the others'
+        weight = min(max(weight, self.min_share), self.budget)
+        with self.cond:
+            self.tickets.value += 1
+            ticket = self.tickets.value
+            # a big job waiting for memory holds back the jobs arriving after it
+            while (self.reserved.value > 0 and
+                    self.reserved.value + weight +
+                        (self.pending.value if self.pending_ticket.value != ticket else 0) > self.budget):
+                if weight > self.pending.value:
+                    self.pending.value = weight
+                    self.pending_ticket.value = ticket
+                self.cond.wait(1)
+            if self.pending_ticket.value == ticket:
+                self.pending.value = 0
+                self.pending_ticket.value = 0
+            self.reserved.value += weight
+        self.weight = weight
+        ld('MemoryGovernor acquire', weight, self.reserved.value)
+        self.adjust()
+
+    def release(self):
+        with self.cond:
+            self.reserved.value = max(self.reserved.value - self.weight, 0)
+            self.cond.notify_all()
+        ld('MemoryGovernor release', self.weight, self.reserved.value)
+        self.weight = 0
+
+    def share(self):
+        'the current job\'s part of the budget, grows as the other jobs finish'
+        reserved = self.reserved.value
+        if not self.weight or not reserved:
+            return self.budget
+        return int(self.budget * self.weight / max(reserved, self.weight))
+
+    def cache_max(self):
+        share = self.share()
+        cache = share * self.cache_part
+        rss = process_rss()
+        if rss and rss > share: # the process is over its share: shrink the block cache
+            cache -= rss - share
+        return int(max(cache, self.min_share / 2))
+
+    def warp_memory(self):
+        return int(max(self.share() * (1 - self.cache_part), self.min_share / 2))
+
+    def adjust(self):
+        'resize GDAL block cache to the current share'
+        gdal.SetCacheMax(self.cache_max())
+
+# MemoryGovernor
+
+mem_governor = None
+
+def set_mem_governor(governor):
+    'pool initializer: make the governor available to a worker process'
+    global mem_governor
+    mem_governor = governor
+
 #############################
 #
 # GDAL utility functions
@@ -251,9 +475,12 @@ def load_geo_defs(csv_file):
     return defs
 
 geo_defs_override_file = 'data_override.csv'
-geo_defs_override = load_geo_defs(geo_defs_override_file)
+geo_defs_override = None # loaded on the first use
 
 def txt2srs(proj):
+    global geo_defs_override
+    if geo_defs_override is None:
+        geo_defs_override = load_geo_defs(geo_defs_override_file)
     srs = osr.SpatialReference()
     proj_ovr = geo_defs_override['proj'].get(proj)
     if proj_ovr:
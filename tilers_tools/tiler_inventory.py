@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from __future__ import with_statement
+
+import os
+import os.path
+import re
+import mmap
+import struct
+
+from tiler_functions import *
+
+#############################
+
+class TileInventory(object):
+    '''Binary index of the tiles in a tile set.
+
+    A tile is identified by the three numbers of its path in their order,
+    for example (z, y, x) for 'z3/5/4.png'. Every zoom is split into pages of
+    64x64 tiles, only the pages with tiles are kept. A page holds a 2-bit code
+    per tile: absent, opaque, semi-transparent or of unknown opacity;
+    optionally a crc32 of tile's content.
+    The file is memory mapped, a page is copied into memory when it's modified.
+    '''
+#############################
+    file_name = 'inventory.bin'
+    magic = 'TINV'
+    version = 2
+    header = struct.Struct('<4sHH32s8s') # magic, version, number of zooms, path template, extension
+    zoom_header = struct.Struct('<BBxxI') # zoom, flags, number of pages
+    page_header = struct.Struct('<ii') # page numbers: a >> page_shift, b >> page_shift
+    HASHES = 1
+
+    page_shift = 6
+    page_mask = (1 << page_shift) - 1
+    page_cells = 1 << (page_shift * 2)
+
+    # opacity <-> 2-bit code
+    UNKNOWN = None
+    opacity_codes = {1: 1, -1: 2, None: 3}
+    code_opacities = {1: 1, 2: -1, 3: None}
+
+    path_re = re.compile(r'[^0-9]*([0-9]+)/([0-9]+)/([0-9]+)[^/]*$')
+
+    def __init__(self, root, template='z%i/%i/%i', ext='', hashes=False):
+        self.root = root
+        self.path = os.path.join(root, self.file_name)
+        self.template = template
+        self.ext = ext
+        self.hashes = hashes
+        self.zooms = {} # zoom -> {(page a, page b): page}
+        self.mm = None
+        self.modified = False
+        if os.path.exists(self.path):
+            self.load()
+
+    @classmethod
+    def exists(cls, root):
+        return os.path.exists(os.path.join(root, cls.file_name))
+
+    def __getstate__(self): # mapped pages are not pickled, workers map the file again
+        return (self.root, self.template, self.ext, self.hashes)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_zooms, template, ext = self.header.unpack_from(self.mm)
+        if magic != self.magic or version != self.version:
+            raise Exception('Invalid tile inventory: %s' % self.path)
+        self.template = template.rstrip('\0')
+        self.ext = ext.rstrip('\0')
+
+        bits_size = self.page_cells // 4
+        crc_size = self.page_cells * 4
+        offset = self.header.size
+        for i in range(n_zooms):
+            zoom, flags, n_pages = self.zoom_header.unpack_from(self.mm, offset)
+            offset += self.zoom_header.size
+            pages = self.zooms[zoom] = {}
+            for j in xrange(n_pages):
+                key = self.page_header.unpack_from(self.mm, offset)
+                offset += self.page_header.size
+                page = LooseDict(bits=buffer(self.mm, offset, bits_size), crc=None)
+                offset += bits_size
+                if flags & self.HASHES:
+                    self.hashes = True
+                    page.crc = buffer(self.mm, offset, crc_size)
+                    offset += crc_size
+                pages[key] = page
+
+    def flush(self):
+        'write the inventory if modified'
+        if not self.modified:
+            return
+        zooms = []
+        for zoom in sorted(self.zooms):
+            pages = [(key, page) for key, page in sorted(self.zooms[zoom].items())
+                if str(page.bits).strip('\0')] # the emptied pages are dropped
+            if pages:
+                zooms.append((zoom, pages))
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.version, len(zooms), self.template, self.ext))
+            for zoom, pages in zooms:
+                hashes = any((page.crc is not None for key, page in pages))
+                f.write(self.zoom_header.pack(zoom, self.HASHES if hashes else 0, len(pages)))
+                for key, page in pages:
+                    f.write(self.page_header.pack(*key))
+                    f.write(page.bits)
+                    if hashes:
+                        f.write(page.crc if page.crc is not None else bytearray(self.page_cells * 4))
+        if self.mm is not None: # a mapped file can't be replaced on Windows
+            self.mm.close()
+            self.mm = None
+        replace_file(tmp, self.path) # readers see either the old or the new inventory
+        self.modified = False
+        # the pages still mapped from the old file are gone with the map
+        self.zooms = {}
+        self.load()
+
+    #----------------------------
+    #
+    # tiles and paths
+    #
+    #----------------------------
+
+    def tile(self, path):
+        'tile numbers from a relative path'
+        m = self.path_re.search(path)
+        if not m:
+            raise ValueError('Not a tile path: %s' % path)
+        return tuple(map(int, m.groups()))
+
+    def tile_path(self, tile):
+        return (self.template % tuple(tile)) + self.ext
+
+    def page_key(self, tile):
+        return (tile[1] >> self.page_shift, tile[2] >> self.page_shift)
+
+    def cell(self, tile):
+        'index of a tile in its page'
+        return ((tile[1] & self.page_mask) << self.page_shift) | (tile[2] & self.page_mask)
+
+    def index(self, tile):
+        'page and cell index of a tile, None if the tile has no page'
+        page = self.zooms.get(tile[0], {}).get(self.page_key(tile))
+        if page is None:
+            return None, None
+        return page, self.cell(tile)
+
+    def code(self, tile):
+        page, i = self.index(tile)
+        if i is None:
+            return 0
+        byte = page.bits[i >> 2]
+        if not isinstance(byte, int): # mapped buffer
+            byte = ord(byte)
+        return (byte >> ((i & 3) * 2)) & 3
+
+    def __contains__(self, tile):
+        return self.code(tile) != 0
+
+    def get(self, tile, default=None):
+        'opacity of a tile (1 or -1), default if absent or not known'
+        return self.code_opacities.get(self.code(tile), default)
+
+    def crc(self, tile):
+        page, i = self.index(tile)
+        if i is None or page.crc is None:
+            return None
+        return struct.unpack_from('<I', page.crc, i * 4)[0]
+
+    def tiles(self, zoom=None):
+        'existing tiles of a zoom or of all the zooms'
+        for z in ([zoom] if zoom is not None else sorted(self.zooms)):
+            pages = self.zooms.get(z, {})
+            for key in sorted(pages):
+                a0, b0 = key[0] << self.page_shift, key[1] << self.page_shift
+                bits = pages[key].bits
+                for byte_i in xrange(len(bits)):
+                    byte = bits[byte_i]
+                    if not isinstance(byte, int):
+                        byte = ord(byte)
+                    if not byte: # 4 tiles absent
+                        continue
+                    for j in range(4):
+                        if (byte >> (j * 2)) & 3:
+                            i = byte_i * 4 + j
+                            yield (z, a0 + (i >> self.page_shift), b0 + (i & self.page_mask))
+
+    def paths(self, zoom=None):
+        return (self.tile_path(tile) for tile in self.tiles(zoom))
+
+    def zoom_levels(self):
+        return [z for z in sorted(self.zooms) if next(self.tiles(z), None) is not None]
+
+    #----------------------------
+    #
+    # modification
+    #
+    #----------------------------
+
+    def writable(self, tile):
+        'the page of a tile copied into memory, a new one if the tile has none'
+        pages = self.zooms.setdefault(tile[0], {})
+        key = self.page_key(tile)
+        page = pages.get(key)
+        if page is None:
+            page = pages[key] = LooseDict(bits=bytearray(self.page_cells // 4), crc=None)
+        elif not isinstance(page.bits, bytearray):
+            page.bits = bytearray(page.bits)
+            if page.crc is not None:
+                page.crc = bytearray(page.crc)
+        if page.crc is None and self.hashes:
+            page.crc = bytearray(self.page_cells * 4)
+        self.modified = True
+        return page
+
+    def set_code(self, tile, code):
+        page = self.writable(tile)
+        i = self.cell(tile)
+        shift = (i & 3) * 2
+        page.bits[i >> 2] = (page.bits[i >> 2] & ~(3 << shift)) | (code << shift)
+
+    def set_crc(self, tile, crc):
+        page = self.writable(tile)
+        struct.pack_into('<I', page.crc, self.cell(tile) * 4, crc & 0xFFFFFFFF)
+
+    def set(self, tile, opacity=UNKNOWN, crc=None):
+        'add a tile, a fully transparent one (opacity 0) is removed'
+        if opacity == 0:
+            self.remove(tile)
+            return
+        self.set_code(tile, self.opacity_codes[opacity])
+        if crc is not None:
+            self.set_crc(tile, crc)
+
+    def remove(self, tile):
+        if tile in self:
+            self.set_code(tile, 0)
+
+    def set_ext(self, ext):
+        'tiles are converted to another format'
+        if ext != self.ext:
+            self.ext = ext
+            self.modified = True
+
+    def remove_zoom(self, zoom):
+        if self.zooms.pop(zoom, None) is not None:
+            self.modified = True
+
+    def update(self, transparency):
+        'add tiles from a dict of {relative path: opacity}'
+        for path, opacity in transparency.iteritems():
+            self.set(self.tile(path), opacity)
+
+# TileInventory
@@ -23,10 +23,48 @@
 #  DEALINGS IN THE SOFTWARE.
 ###############################################################################
 
+import Queue
+import threading
+
 from tiler_functions import *
 from tiler_backend import *
 
 
+#############################
+
+class BackgroundWriter(threading.Thread):
+    '''runs metadata writing jobs off the tile rendering path'''
+#############################
+
+    def __init__(self, max_jobs=1000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.jobs = Queue.Queue(max_jobs)
+        self.error = None
+        self.start()
+
+    def put(self, func, *args):
+        self.jobs.put((func, args))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            if self.error is None:
+                try:
+                    func, args = job
+                    func(*args)
+                except Exception as exc:
+                    self.error = exc
+
+    def close(self):
+        'wait for the jobs to finish'
+        self.jobs.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
 #############################
 
 class PlateCarree(MercatorPyramid):
@@ -50,6 +88,29 @@ class PlateCarree(MercatorPyramid):
 
     #~ srs = 'EPSG:4326'
 
+    kml_writer = None
+    kml_blocks = None
+    longlat_affine = None
+
+    def map_tiles2longlat_bounds(self, tiles):
+        '''lon/lat boxes of tiles; the SRS is linear in degrees,
+        so its affine transformation to lon/lat is computed just once'''
+        if self.longlat_affine is None or self.longlat_affine[0] != self.proj_srs:
+            (lon0, lat0), (lon1, lat1) = self.coords2longlat([(0, 0), (1, 1)])
+            self.longlat_affine = (self.proj_srs, lon0, lon1 - lon0, lat0, lat1 - lat0)
+        srs, lon0, dlon, lat0, dlat = self.longlat_affine
+
+        boxes = []
+        for tile in tiles:
+            (x0, y0), (x1, y1) = self.tile_corners(tile)
+            w = lon0 + dlon * x0
+            e = lon0 + dlon * x1
+            boxes.append([
+                (w if w <  180 else w - 360, lat0 + dlat * y0),
+                (e if e > -180 else e + 360, lat0 + dlat * y1),
+                ])
+        return boxes
+
     def kml_child_links(self, children, parent=None, path_prefix=''):
         kml_links = []
         # convert tiles to degree boxes
@@ -80,28 +141,108 @@ class PlateCarree(MercatorPyramid):
             }
         open(os.path.join(self.dest, rel_path+'.kml'), 'w+').write(kml)
 
-    def write_metadata(self, tile=None, children=[]):
-        super(PlateCarree, self).write_metadata(tile, children)
-
-        if tile is None: # create top level kml
-            self.write_kml(os.path.basename(self.base), os.path.basename(self.base), self.kml_child_links(children))
-            return
-        # fill in kml templates
-        rel_path = self.tile_path(tile)
-        name = os.path.splitext(rel_path)[0]
-        kml_links = self.kml_child_links(children, tile, '../../')
-        tile_box = self.map_tiles2longlat_bounds([tile])[0]
-        w, n, e, s = ['%r' % v for v in flatten(tile_box)]
-        kml_overlay = kml_overlay_templ % {
-            'name':    name,
-            'href':    os.path.basename(rel_path),
+    def kml_overlay(self, tile, href, has_children):
+        w, n, e, s = ['%r' % v for v in flatten(self.map_tiles2longlat_bounds([tile])[0])]
+        return kml_overlay_templ % {
+            'name':    os.path.splitext(self.tile_path(tile))[0],
+            'href':    href,
             'min_lod': 128,
-            'max_lod': 2048 if kml_links else -1,
+            'max_lod': 2048 if has_children else -1,
             'order':   tile[0],
             'west':    w, 'north':    n,
             'east':    e, 'south':    s,
             }
+
+    def write_tile_kml(self, tile, children):
+        # fill in kml templates
+        rel_path = self.tile_path(tile)
+        name = os.path.splitext(rel_path)[0]
+        kml_links = self.kml_child_links(children, tile, '../../')
+        kml_overlay = self.kml_overlay(tile, os.path.basename(rel_path), kml_links)
         self.write_kml(name, name, kml_links, kml_overlay)
+
+    def write_metadata(self, tile=None, children=[]):
+        super(PlateCarree, self).write_metadata(tile, children)
+
+        block = self.options.kml_block
+        if tile is None: # create top level kml
+            self.flush_metadata()
+            if block:
+                self.write_kml_blocks()
+                links = self.kml_block_links(children, 'kml/')
+            else:
+                links = self.kml_child_links(children)
+            self.write_kml(os.path.basename(self.base), os.path.basename(self.base), links)
+            return
+
+        if block: # collect the tiles of a block, the blocks are written at the end
+            if self.kml_blocks is None:
+                self.kml_blocks = {}
+            self.kml_blocks.setdefault(self.kml_block_id(tile), []).append((tile, children))
+            return
+
+        # write tile's kml in the background
+        if self.kml_writer is None:
+            self.kml_writer = BackgroundWriter()
+        self.kml_writer.put(self.write_tile_kml, tile, children)
+
+    def flush_metadata(self):
+        if self.kml_writer is not None:
+            self.kml_writer.close()
+            self.kml_writer = None
+
+    def split_tiles(self, n_parts):
+        if self.options.kml_block: # kml blocks can not be shared by parts
+            zoom = self.zoom_range[-1]
+            return zoom, [list(self.zoom_tiles(zoom))]
+        return super(PlateCarree, self).split_tiles(n_parts)
+
+    #
+    # kml regions packed into a file per block of N x N tiles
+    #
+
+    def kml_block_id(self, tile):
+        z, x, y = self.normalize_tile(tile)
+        n = self.options.kml_block
+        return (z, x // n, y // n)
+
+    def kml_block_path(self, block_id):
+        return 'z%i/%i_%i' % block_id
+
+    def kml_block_links(self, tiles, path_prefix=''):
+        'links to the blocks of the tiles, a block region covers its tiles'
+        blocks = {}
+        for tile, box in zip(tiles, self.map_tiles2longlat_bounds(tiles)):
+            blocks.setdefault(self.kml_block_id(tile), []).append(box)
+
+        kml_links = []
+        for block_id in sorted(blocks):
+            (ww, nn), (ee, ss) = zip(*blocks[block_id])
+            w, n, e, s = ['%.11f' % v for v in (min(ww), max(nn), max(ee), min(ss))]
+            name = self.kml_block_path(block_id)
+            kml_links.append(kml_link_templ % {
+                'name':    name,
+                'href':    path_prefix + name + '.kml',
+                'west':    w, 'north':    n,
+                'east':    e, 'south':    s,
+                'min_lod': 128,
+                'max_lod': -1,
+                })
+        return ''.join(kml_links)
+
+    def write_kml_blocks(self):
+        kml_dir = os.path.join(self.dest, 'kml')
+        for block_id, tile_lst in (self.kml_blocks or {}).items():
+            name = self.kml_block_path(block_id)
+            overlays = ''.join((kml_folder_templ % self.kml_overlay(tile, '../../' + self.tile_path(tile), children)
+                for tile, children in tile_lst))
+            links = self.kml_block_links(flatten((children for tile, children in tile_lst)), '../')
+            try:
+                os.makedirs(os.path.join(kml_dir, os.path.dirname(name)))
+            except os.error:
+                pass
+            self.write_kml(os.path.join('kml', name), name, links, overlays)
+        self.kml_blocks = None
 # PlateCarree
 
 #############################
@@ -175,6 +316,10 @@ kml_overlay_templ = '''
             </LatLonBox>
         </GroundOverlay>'''
 
+kml_folder_templ = '''
+    <Folder>%s
+    </Folder>'''
+
 kml_link_templ = '''
         <NetworkLink>
             <name>%(name)s</name>
@@ -24,19 +24,19 @@
 ###############################################################################
 
 import sys
+import imp
 import logging
 import optparse
 
 from tiler_functions import *
 
-from converter_backend import TileSet, TileConverter
-import converter_xyz
-import converter_maemomapper
-import converter_sasplanet
-try:
-    import converter_mmaps
+from converter_backend import TileSet, TileConverter, tileset_profiles
+try: # the profile module is imported only when selected
+    imp.find_module('converter_mmaps')
+    tileset_profiles.register('converter_mmaps', 'mmaps')
+    converter_mmaps = True
 except ImportError:
-    pass
+    converter_mmaps = None
 
 #~ import rpdb2; rpdb2.start_embedded_debugger('nRAmgJHm')
 
@@ -64,11 +64,10 @@ def main(argv):
         description='copies map tiles from one structure to another')
     parser.add_option('--from', dest='in_fmt', default='zyx',
         help='input tiles profile (default: zyx)')
-    try:
-        converter_mmaps # test availability
+    if converter_mmaps:
         parser.add_option('--to', dest='out_fmt', default='mmaps',
             help='output tiles profile (default: mmaps)')
-    except NameError:
+    else:
         parser.add_option('--to', dest='out_fmt', default='xyz',
             help='output tiles profile (default: xyz)')
     parser.add_option('--list-profiles', '--lp', action='store_true',
@@ -95,6 +94,8 @@ def main(argv):
         help='non-base layer (default: False)')
     parser.add_option('--url', default=None,
         help='URL template (default: None)')
+    parser.add_option('--tile-hashes', action='store_true',
+        help='keep crc32 of the tiles in the tile inventory of a destination')
     parser.add_option('--link', action='store_true', dest='link',
         help='make links to source tiles instead of copying if possible')
     parser.add_option("--srs", default='EPSG:3857', dest="tiles_srs",
@@ -107,6 +108,12 @@ def main(argv):
         help='region to process (OGR shape or Sasplanet .hlg)')
     parser.add_option('--region-zoom', metavar='N', type="int", default=None,
         help='apply region for zooms only higher than this one (default: None)')
+    parser.add_option("--db-buffer", type="int", default=16, metavar="MB",
+        help='slite, mapper, mbtiles: tiles buffered and written grouped by database file (default: 16)')
+    parser.add_option("--shm-ring", type="int", default=64, metavar="MB",
+        help='pass tiles to the converter workers through a shared memory ring of MB, 0 to pickle them (default: 64)')
+    parser.add_option("--readers", type="int", default=cpu_count(), metavar="N",
+        help='without --tile-format read a multi-file source by N processes, 0 to read it here (default: number of CPUs)')
     parser.add_option("--nothreads", action="store_true",
         help="do not use multiprocessing")
 
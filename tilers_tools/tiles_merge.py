@@ -34,6 +34,7 @@ from PIL import Image
 import pickle
 
 from tiler_functions import *
+from tiler_inventory import TileInventory
 
 class KeyboardInterruptError(Exception):
     pass
@@ -73,20 +74,33 @@ class MergeSet:
         self.tile_size = self.src['tiles']['size']
 
         # get a list of source tiles
-        try:
-            cwd = os.getcwd()
-            os.chdir(src_dir)
-            self.sources = dict.fromkeys(
-                glob.iglob('z[0-9]*/*/*.%s' % self.src['tiles']['ext']),
-                None
-                )
-        finally:
-            os.chdir(cwd)
+        self.indexed = TileInventory.exists(src_dir)
+        self.src_inv = TileInventory(src_dir, 'z%i/%i/%i', '.' + self.src['tiles']['ext'])
+        if self.indexed: # no need to scan the source
+            self.sources = dict((
+                (self.src_inv.tile_path(tile), self.src_inv.get(tile))
+                    for tile in self.src_inv.tiles()
+                ))
+        else:
+            try:
+                cwd = os.getcwd()
+                os.chdir(src_dir)
+                self.sources = dict.fromkeys(
+                    glob.iglob('z[0-9]*/*/*.%s' % self.src['tiles']['ext']),
+                    None
+                    )
+            finally:
+                os.chdir(cwd)
+
+            # load cached tile transparency data if any
+            self.sources.update(read_transparency(src_dir))
         #ld(self.sources)
 
-        # load cached tile transparency data if any
-        self.sources.update(read_transparency(src_dir))
-        #ld(repr(self.src_transp))
+        # an inventory of the destination unless it has tiles merged without it
+        if TileInventory.exists(dst_dir) or not glob.glob(os.path.join(dst_dir, 'z[0-9]*')):
+            self.dst_inv = TileInventory(dst_dir, self.src_inv.template, self.src_inv.ext)
+        else:
+            self.dst_inv = None
 
         # define crop map for underlay function
         szx, szy = self.tile_size
@@ -120,6 +134,11 @@ class MergeSet:
 
         write_tilemap(self.dst_dir, dst)
 
+    def dst_exists(self, tile):
+        if self.dst_inv is not None:
+            return self.dst_inv.tile(tile) in self.dst_inv
+        return os.path.exists(os.path.join(self.dst_dir, tile))
+
     def underlay(self, tile, upper_path, upper_raster, upper_origin=(0, 0), level=1):
         if level > options.underlay:
             return
@@ -141,7 +160,7 @@ class MergeSet:
             l2 = 2**level
             crop_origin = [p1 + p2/l2 for p1, p2 in zip(upper_origin, crop_offset)]
 
-            if os.path.exists(dst_path):
+            if self.dst_exists(dst_tile):
                 dst_raster = Image.open(dst_path).convert("RGBA")
                 if transparency(dst_raster) == 1: # lower tile is fully opaque
                     continue
@@ -174,8 +193,8 @@ class MergeSet:
         try:
             #~ ld(self.src_dir, self.dst_dir, tile)
             src_file = os.path.join(self.src_dir, tile)
-            if not os.path.exists(src_file):
-                return None, None
+            if not self.indexed and not os.path.exists(src_file):
+                return None, None, None
 
             src_raster = None
             transp = self.sources[tile]
@@ -186,7 +205,7 @@ class MergeSet:
             if  transp == 0 : # fully transparent
                 #~ pf('-', end='')
                 os.remove(src_file)
-                return None, None
+                return None, None, None
 
             dst_file = os.path.join(self.dst_dir, tile)
             dpath = os.path.dirname(dst_file)
@@ -195,10 +214,11 @@ class MergeSet:
                     os.makedirs(dpath)
                 except os.error:
                     pass
-            if transp == 1 or not os.path.exists(dst_file):
+            if transp == 1 or not self.dst_exists(tile):
                 # fully opaque or no destination tile exists yet
                 #~ pf('>', end='')
                 link_or_copy(src_file, dst_file)
+                dst_transp = transp
             else: # partially transparent, combine with destination (exists! see previous check)
                 pf('+', end='')
                 if not src_raster:
@@ -209,6 +229,8 @@ class MergeSet:
                     error('merge_tile', exception.message, dst_file)
 
                 dst_raster.save(dst_file)
+                # over an opaque tile stays opaque, otherwise it's to be checked
+                dst_transp = 1 if self.dst_inv is not None and self.dst_inv.get(self.dst_inv.tile(tile)) == 1 else None
 
             if options.underlay and transp != 0:
                 self.underlay(tile, src_file, src_raster)
@@ -216,20 +238,29 @@ class MergeSet:
         except KeyboardInterrupt: # http://jessenoller.com/2009/01/08/multiprocessingpool-and-keyboardinterrupt/
             print 'got KeyboardInterrupt'
             raise KeyboardInterruptError()
-        return (tile, transp) # send back transparency values for caching
+        return (tile, transp, dst_transp) # send back transparency values for caching
 
     def merge_dirs(self):
 
-        transparency = parallel_map(self, self.sources.keys())
+        src_tiles = self.sources.keys()
+        merged = [res for res in parallel_map(self, src_tiles) if res[0] is not None]
         self.sources = None
-        self.sources = dict(transparency)
-        if None in self.sources:
-            del self.sources[None]
+        self.sources = dict(((tile, transp) for tile, transp, dst_transp in merged))
 
         self.merge_metadata()
 
-        # save transparency data
+        # save transparency data and tile inventories
         write_transparency(self.src_dir, self.sources)
+        for tile in src_tiles:
+            if tile not in self.sources: # removed as transparent
+                self.src_inv.remove(self.src_inv.tile(tile))
+        self.src_inv.update(self.sources)
+        self.src_inv.flush()
+
+        if self.dst_inv is not None:
+            for tile, transp, dst_transp in merged:
+                self.dst_inv.set(self.dst_inv.tile(tile), dst_transp)
+            self.dst_inv.flush()
         pf('')
 
 # MergeSet end
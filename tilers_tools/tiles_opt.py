@@ -28,15 +28,19 @@ import stat
 import shutil
 import logging
 import optparse
+from subprocess import Popen, PIPE
 from PIL import Image
 #~ from PIL import WebPImagePlugin
 
 from tiler_functions import *
+from tiler_inventory import TileInventory
 
 class KeyboardInterruptError(Exception): pass
 
 converters = []
 
+helpers = {} # long-lived helper processes of a worker by their command
+
 #############################
 
 class Converter (object):
@@ -73,7 +77,15 @@ class Converter (object):
         finally:
             os.chdir(cwd)
 
-        parallel_map(self, src_lst)
+        if self.options.batch: # groups of files of the same directory
+            src_lst.sort()
+            batches = []
+            for path, files in itertools.groupby(src_lst, os.path.dirname):
+                files = list(files)
+                batches.extend((files[i: i + self.options.batch] for i in range(0, len(files), self.options.batch)))
+            parallel_map(self, batches, chunksize=1)
+        else:
+            parallel_map(self, src_lst)
 
         tilemap = os.path.join(self.dst_dir, 'tilemap.json')
         if os.path.exists(tilemap):
@@ -81,11 +93,18 @@ class Converter (object):
                 ('"mime":[^,]*"', '"mime": "%s"' % mime_from_ext(self.dst_ext)),
                 ('"ext":[^,]*"', '"ext": "%s"' % self.dst_ext[1:]),
                 ])
+        if TileInventory.exists(self.dst_dir): # copied from the source
+            inventory = TileInventory(self.dst_dir)
+            inventory.set_ext(self.dst_ext)
+            inventory.flush()
         pf('')
 
     def __call__(self, f):
-        'process file'
+        'process a file or a batch (list) of files'
         try:
+            if isinstance(f, list):
+                return self.process_batch(f)
+
             src = os.path.join(self.src_dir, f)
             dst = os.path.splitext(os.path.join(self.dst_dir, f))[0] + self.dst_ext
 
@@ -104,9 +123,56 @@ class Converter (object):
             pf('got KeyboardInterrupt')
             raise KeyboardInterruptError()
 
+    def process_batch(self, files):
+        'convert files of the same directory together'
+        tiles = []
+        for f in files:
+            src = os.path.join(self.src_dir, f)
+            dst = os.path.splitext(os.path.join(self.dst_dir, f))[0] + self.dst_ext
+            dpath = os.path.split(dst)[0]
+            if not os.path.exists(dpath):
+                os.makedirs(dpath)
+
+            if os.path.splitext(f)[1].lower() in self.src_formats:
+                tiles.append((src, dst))
+            else:
+                shutil.copy(src, dpath)
+                self.counter()
+        if tiles:
+            self.convert_batch(tiles, dpath)
+            for tile in tiles:
+                self.counter()
+
+    def convert_batch(self, tiles, dpath):
+        for src, dst in tiles:
+            self.convert_tile(src, dst, dpath)
+
     def convert_tile(self, src, dst, dpath):
         pass
 
+    def helper(self, cmd):
+        '''a shell of this worker process which runs a single-file tool for every (src, dst) line it reads,
+        saves starting a process from the (large) python one for every file'''
+        proc = helpers.get(cmd)
+        if proc is None or proc.poll() is not None:
+            script = ('while IFS="$(printf \'\\t\')" read -r src dst; do '
+                'if %s >/dev/null 2>&1; then echo ok; else echo "error $src"; fi; done' % cmd)
+            proc = helpers[cmd] = Popen(['sh', '-c', script], stdin=PIPE, stdout=PIPE)
+        return proc
+
+    def run_helper(self, cmd, tiles):
+        'feed a batch of (src, dst) to a helper a line at a time, so neither side waits on a full pipe'
+        proc = self.helper(cmd)
+        for tile in tiles:
+            try:
+                proc.stdin.write('%s\t%s\n' % tile)
+                proc.stdin.flush()
+                res = proc.stdout.readline().strip()
+            except IOError: # the helper has quit
+                res = None
+            if res != 'ok':
+                logging.error('%s: %s' % (cmd.split()[0], res or 'helper has quit'))
+
     tick_rate = 10
     tick_count = 0
 
@@ -145,6 +211,10 @@ class PngConverter (Converter):
         'optimize png using pngnq utility'
         command(['pngnq', '-n', self.options.colors, '-e', self.dst_ext, '-d', dpath, src])
 
+    def convert_batch(self, tiles, dpath):
+        'pngnq takes many files of a directory at once'
+        command(['pngnq', '-n', self.options.colors, '-e', self.dst_ext, '-d', dpath] + [src for src, dst in tiles])
+
 converters.append(PngConverter)
 
 #############################
@@ -153,12 +223,16 @@ class WebpConverter (Converter):
     'convert to webp'
 #############################
     profile_name = 'webp'
+    prog_name = 'cwebp'
     dst_ext = '.webp'
     src_formats = ('.png','.jpg','.jpeg','.gif')
 
     def convert_tile(self, src, dst, dpath):
         command(['cwebp', src, '-o', dst, '-q', str(self.options.quality)])
 
+    def convert_batch(self, tiles, dpath):
+        self.run_helper('cwebp "$src" -o "$dst" -q %d' % self.options.quality, tiles)
+
 converters.append(WebpConverter)
 
 
@@ -214,6 +288,8 @@ def main(argv):
         help='delete destination directory if any')
     parser.add_option("--quiet", action="store_true")
     parser.add_option("-d", "--debug", action="store_true")
+    parser.add_option("-b", "--batch", type="int", default=None, metavar="N",
+        help='convert files in groups of N: one pngnq call per group, a long-lived helper shell per worker for cwebp')
     parser.add_option("--nothreads", action="store_true",
         help="do not use multiprocessing")
 
@@ -31,6 +31,7 @@ import optparse
 from PIL import Image
 
 from tiler_functions import *
+from tiler_inventory import TileInventory
 
 class ZoomSet:
     def __init__(self,tiles_dir):
@@ -43,6 +44,10 @@ class ZoomSet:
 
         self.tilemap=read_tilemap(self.tiles_root)
 
+        # tiles are listed by the inventory if there is one
+        self.indexed=TileInventory.exists(self.tiles_root)
+        self.inventory=TileInventory(self.tiles_root,'z%i/%i/%i','.'+self.tilemap['tiles']['ext'])
+
         if self.tilemap['tiles']['inversion'][1]: # google
             self.tile_offsets=[
                 (0,0), (128,0),
@@ -92,11 +97,15 @@ class ZoomSet:
                     'units_per_pixel': tilesets[zoom + 1]['units_per_pixel'] * 2}
 
                 shutil.rmtree(z_dir, ignore_errors=True)
-                os.chdir(os.path.join(self.tiles_root, 'z%i' % (zoom+1)))
+                self.inventory.remove_zoom(zoom)
+                if self.indexed:
+                    self.src_lst=set([(y,x) for z,y,x in self.inventory.tiles(zoom+1)])
+                else:
+                    os.chdir(os.path.join(self.tiles_root, 'z%i' % (zoom+1)))
 
-                self.src_lst=set(
-                    [tuple(map(int,path2list(f)[:-1]))
-                        for f in glob.glob('*/*.%s' % self.tilemap['tiles']['ext'])])
+                    self.src_lst=set(
+                        [tuple(map(int,path2list(f)[:-1]))
+                            for f in glob.glob('*/*.%s' % self.tilemap['tiles']['ext'])])
 
                 os.chdir(self.tiles_root)
 
@@ -110,12 +119,27 @@ class ZoomSet:
 
                 parallel_map(self,dest_lst)
 
+                if self.indexed:
+                    for (z,y,x) in dest_lst:
+                        self.inventory.set((z,y,x),self.scaled_opacity(z,y,x))
+
             write_tilemap('.',self.tilemap)
+            self.inventory.flush()
 
         finally:
             os.chdir(start_dir)
             pf('')
 
+    def scaled_opacity(self,z,y,x):
+        'a zoomed out tile is opaque only if all 4 source tiles are'
+        opacities=[self.inventory.get((z+1,sy,sx)) if (sy,sx) in self.src_lst else -1
+                    for sy,sx in [(y*2,x*2),(y*2,x*2+1),(y*2+1,x*2),(y*2+1,x*2+1)]]
+        if -1 in opacities:
+            return -1
+        if None in opacities:
+            return None
+        return 1
+
 # ZoomSet end
 
 if __name__=='__main__':